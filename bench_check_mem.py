@@ -0,0 +1,188 @@
+#!/usr/bin/env python2
+'''
+Benchmarks the stages of a check_mem.py run against the recorded
+outputs in fixtures/ so results are comparable between hosts and
+commits.
+
+Usage:
+# time every stage and write the results as JSON
+python bench_check_mem.py --output bench.json
+
+# compare against an earlier run, exit 1 if any stage got more than 25% slower
+python bench_check_mem.py --baseline bench.json --tolerance 0.25
+'''
+
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import subprocess
+from optparse import OptionParser
+
+import check_mem
+from check_mem import MemoryState
+
+from nagpyrc import NagiosReturn
+from nagpyrc import NagiosReturnCode
+
+here = os.path.dirname(os.path.abspath(__file__))
+fixturedir = os.path.join(here, 'fixtures')
+
+# free -b fixtures and the 'free -V' version they were recorded with
+FREE_FIXTURES = (('free_b_procps-3.3.9.txt', '3.3.9'),
+                 ('free_b_procps-ng-3.3.10.txt', '3.3.10'),
+                 ('free_b_procps-ng-4.0.2.txt', '4.0.2'))
+MEMINFO_FIXTURE = 'meminfo.txt'
+
+
+def read_fixture(name):
+    with open(os.path.join(fixturedir, name)) as f:
+        return f.read()
+
+
+def time_stage(func, number, repeat):
+    # best per call time in microseconds, the least noisy figure timeit gives
+    timings = timeit.Timer(func).repeat(repeat, number)
+    return min(timings) / number * 1000000
+
+
+def time_cold_launch(args, repeat):
+    # wall clock of a fresh interpreter running the script, in microseconds.
+    # no probe cache, so every launch is cold and the host's cache is left alone
+    timings = []
+    for i in range(repeat):
+        started = time.time()
+        p = subprocess.Popen([sys.executable, os.path.join(here, 'check_mem.py'),
+                              '--probe_cache', ''] + args,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=here)
+        p.communicate()
+        timings.append(time.time() - started)
+    return min(timings) * 1000000
+
+
+def generate_returncode(memstats):
+    nm = NagiosReturnCode(returncode=0, msgstring=check_mem.build_message(memstats))
+    for pc in check_mem.build_perfdata(memstats):
+        nm.perfChunkList.append(pc)
+    try:
+        nm.genreturncode()
+    except NagiosReturn as e:
+        return e.message
+
+
+def run_benchmarks(number, repeat, launches):
+    '''
+    Returns {stage: microseconds per call} for every stage of a run.
+    '''
+    results = {}
+    meminfo = read_fixture(MEMINFO_FIXTURE)
+    memstats = check_mem.process_meminfo(check_mem.parse_meminfo(meminfo))
+
+    for name, version in FREE_FIXTURES:
+        lines = read_fixture(name).splitlines(True)
+        results['process_results[%s]' % version] = time_stage(
+            lambda: check_mem.process_results(version, lines), number, repeat)
+    # fork + exec + read of a free sized output, what the free collector pays twice
+    path = os.path.join(fixturedir, FREE_FIXTURES[-1][0])
+    results['execute_command'] = time_stage(
+        lambda: check_mem.execute_command(['cat', path]).communicate(),
+        max(number // 100, 1), repeat)
+    results['read_procfile'] = time_stage(
+        lambda: check_mem.read_procfile(os.path.join(fixturedir, MEMINFO_FIXTURE)),
+        number, repeat)
+    results['parse_meminfo'] = time_stage(
+        lambda: check_mem.parse_meminfo(meminfo), number, repeat)
+    results['process_meminfo'] = time_stage(
+        lambda: check_mem.process_meminfo(check_mem.parse_meminfo(meminfo)),
+        number, repeat)
+    # one --samples reading through an already open descriptor
+    sampler = check_mem.MeminfoSampler(os.path.join(fixturedir, MEMINFO_FIXTURE))
+    results['MeminfoSampler'] = time_stage(
+        lambda: check_mem.meminfo_usage(sampler.read()), number, repeat)
+    sampler.close()
+    results['MemoryState'] = time_stage(
+        lambda: MemoryState(8000, 7300, 100, 1, 1, 2000, 10, 1990, None),
+        number, repeat)
+    packed = check_mem.SNAPSHOT_BODY.pack(
+        time.time(), *[int(getattr(memstats, f)) for f in check_mem.SNAPSHOT_FIELDS]) * 100
+    results['MemoryState.from_packed[100]'] = time_stage(
+        lambda: MemoryState.from_packed(packed), max(number // 100, 1), repeat)
+    results['within_critwarn_range'] = time_stage(
+        lambda: memstats.within_critwarn_range(90.0, 95.0, 75.0, 90.0),
+        number, repeat)
+    results['NagiosReturnCode'] = time_stage(
+        lambda: generate_returncode(memstats), number, repeat)
+    if launches:
+        results['cold_launch[procfs]'] = time_cold_launch(
+            ['--perfdata_only', 'yes', '--snapshot_file', '', '--logfile', os.devnull],
+            launches)
+        results['cold_launch[free]'] = time_cold_launch(
+            ['--perfdata_only', 'yes', '--snapshot_file', '', '--logfile', os.devnull,
+             '--collector', 'free'], launches)
+    return results
+
+
+def compare_results(baseline, current, tolerance):
+    '''
+    Returns a list of (stage, baseline_us, current_us) for every stage
+    that got slower than baseline by more than tolerance (0.25 = 25%).
+    Stages missing from either side are ignored.
+    '''
+    regressions = []
+    for stage in sorted(current):
+        if stage in baseline and current[stage] > baseline[stage] * (1 + tolerance):
+            regressions.append((stage, baseline[stage], current[stage]))
+    return regressions
+
+
+def main(options):
+    results = run_benchmarks(int(options.number), int(options.repeat),
+                             int(options.launches))
+    report = {'python': platform.python_version(),
+              'platform': platform.platform(),
+              'timestamp': time.time(),
+              'unit': 'us',
+              'results': results}
+    for stage in sorted(results):
+        print('%-32s %12.2f us' % (stage, results[stage]))
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare_results(baseline, results, float(options.tolerance))
+        for stage, before, after in regressions:
+            print('REGRESSION %s: %.2f us -> %.2f us' % (stage, before, after))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = OptionParser("%prog [--output FILE] [--baseline FILE] [--tolerance 0.25]")
+    parser.add_option('--output', type='string', metavar='FILE',
+                      help="Write results as JSON to FILE. Default='' (don't)",
+                      default='')
+    parser.add_option('--baseline', type='string', metavar='FILE',
+                      help=("Results from an earlier --output run to compare "
+                            "against. Default='' (don't)"),
+                      default='')
+    parser.add_option('--tolerance', type='string',
+                      help=("Fraction a stage may slow down against --baseline "
+                            "before it counts as a regression. Default='0.25'"),
+                      default='0.25')
+    parser.add_option('--number', type='string',
+                      help="Calls per timing of each in-process stage. Default='2000'",
+                      default='2000')
+    parser.add_option('--repeat', type='string',
+                      help="Timings taken per stage, the best is kept. Default='5'",
+                      default='5')
+    parser.add_option('--launches', type='string',
+                      help=("Cold interpreter launches per collector, 0 to skip. "
+                            "Default='5'"),
+                      default='5')
+    options, args = parser.parse_args()
+    sys.exit(main(options))
@@ -14,17 +14,14 @@ python check_mem.py --perfdata_only yes
 
 '''
 
+# Keep module level imports to what every check run needs. Anything
+# only used by one collector or mode is imported where it's used so a
+# poll doesn't pay for it, test_check_mem.Test_startup enforces this.
 import logging
 import sys
 import os
 import time
-import unittest
-import subprocess
-from optparse import OptionParser, OptionGroup
-from datetime import datetime
-from datetime import timedelta
-
-from distutils.version import LooseVersion
+import struct
 
 from nagpyrc import NagiosReturn
 from nagpyrc import PerfChunk
@@ -33,14 +30,135 @@ from nagpyrc import NagiosReturnCode
 sversion = 'v0.1'
 scriptfilename = os.path.basename(sys.argv[0])
 defaultlogfilename = scriptfilename + '.log'
+logformat = '%(asctime)s:%(levelname)s:%(message)s'
+# set by setuplogging() when --logmode is 'buffer'
+logbuffer = None
+# set by start_instrumentation() for --instrument
+phasetimer = None
+# (thresholds, perfdata_only) for --fleet workers, set by fleet_init()
+fleetthresholds = None
+# the installed procps version once probe_procps_version() has asked
+procpsversion = None
+
+PROC_PATH = '/proc'
+MEMINFO_PATH = '/proc/meminfo'
+PRESSURE_PATH = '/proc/pressure/memory'
+PRESSURE_METRICS = ('some_avg10', 'some_avg60', 'some_avg300',
+                    'full_avg10', 'full_avg60', 'full_avg300')
+# only the fields needed to build a MemoryState the same way 'free' does
+MEMINFO_FIELDS = ('MemTotal', 'MemFree', 'MemAvailable', 'Buffers', 'Cached',
+                  'SReclaimable', 'Shmem', 'SwapTotal', 'SwapFree')
+# and the ones --threshold_basis effective accounts for, parsed from the
+# same read by everything but the --samples loop
+ACCOUNTING_FIELDS = ('HugePages_Total', 'HugePages_Free', 'HugePages_Rsvd',
+                     'Hugepagesize', 'Hugetlb', 'Zswap', 'Zswapped')
+SYS_BLOCK_PATH = '/sys/block'
+# the leading /sys/block/zram*/mm_stat columns, in bytes
+ZRAM_MM_STAT_FIELDS = ('zram_orig', 'zram_compr', 'zram_used')
+
+# Fixed layout of the snapshot file shared between the --daemon sampler
+# and regular check invocations:
+#   offset  0: magic, layout version
+#   offset  8: sequence counter (odd while the sampler is writing)
+#   offset 16: sample timestamp followed by the MemoryState fields
+SNAPSHOT_MAGIC = b'CMEM'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<4sI')
+SNAPSHOT_SEQ = struct.Struct('<Q')
+SNAPSHOT_SEQ_OFFSET = SNAPSHOT_HEADER.size
+SNAPSHOT_FIELDS = ('total', 'used', 'free', 'shared', 'buffcache',
+                   'swap_total', 'swap_used', 'swap_free', 'available')
+SNAPSHOT_BODY = struct.Struct('<d%dq' % len(SNAPSHOT_FIELDS))
+SNAPSHOT_BODY_OFFSET = SNAPSHOT_SEQ_OFFSET + SNAPSHOT_SEQ.size
+SNAPSHOT_SIZE = SNAPSHOT_BODY_OFFSET + SNAPSHOT_BODY.size
+defaultsnapshotfile = '/dev/shm/check_mem.snapshot'
+
+# History file: a fixed size ring of samples behind a small header
+#   offset  0: magic, layout version, capacity, number of appends so far
+#   offset 24: capacity records of (timestamp, used, total, swap_used, swap_total)
+HISTORY_MAGIC = b'CMHS'
+HISTORY_VERSION = 1
+HISTORY_HEADER = struct.Struct('<4sIQQ')
+HISTORY_COUNT_OFFSET = 16
+HISTORY_COUNT = struct.Struct('<Q')
+HISTORY_RECORD = struct.Struct('<dqqqq')
+
+RC_NAMES = {0: 'OK', 1: 'WARNING', 2: 'CRITICAL', 3: 'UNKNOWN'}
+# return codes from least to most severe, UNKNOWN ranks below WARNING
+RC_SEVERITY = (0, 3, 1, 2)
+# options a --profiles section may set
+PROFILE_KEYS = ('mem_warn_percentage', 'mem_crit_percentage',
+                'swap_warn_percentage', 'swap_crit_percentage', 'perfdata_only',
+                'tte_warn_minutes', 'tte_crit_minutes', 'psi_warn_percentage',
+                'psi_crit_percentage', 'psi_metric', 'threshold_basis',
+                'service')
+
+# the threshold, mode and output options a --server request may set, the
+# rest keep the defaults so a request can't read or write files
+REQUEST_OPTIONS = ('mem_warn_percentage', 'mem_crit_percentage',
+                   'swap_warn_percentage', 'swap_crit_percentage', 'perfdata_only',
+                   'mode', 'cgroup_top', 'threshold_basis', 'top', 'top_metric',
+                   'top_budget_ms', 'psi', 'psi_warn_percentage',
+                   'psi_crit_percentage', 'psi_metric', 'tte_warn_minutes',
+                   'tte_crit_minutes')
+
+defaultcgrouproot = '/sys/fs/cgroup'
+defaultnoderoot = '/sys/devices/system/node'
+defaultserveraddress = '/run/check_mem.sock'
+defaultprobecachefile = '/var/tmp/check_mem.probe'
+# 'free' versions standing in for the two procps output formats
+FREE_OLD_FORMAT_VERSION = '3.3.9'
+FREE_NEW_FORMAT_VERSION = '3.3.10'
+# the first procps with used = MemTotal - MemAvailable, see used_formula()
+USED_AVAILABLE_VERSION = '4.0.0'
+NODE_MEMINFO_FIELDS = ('MemTotal', 'MemFree', 'FilePages', 'SReclaimable',
+                       'Shmem')
+# memory.stat keys needed to turn memory.current into a MemoryState
+CGROUP_STAT_FIELDS = ('file', 'inactive_file', 'shmem')
+
 
+class RingBufferHandler(logging.Handler):
+    '''
+    Keeps the last capacity log records in memory, unformatted, so a
+    check that comes back OK never touches the disk. write() appends
+    them to a size rotated log file when there's a reason to read them.
+    '''
+
+    def __init__(self, capacity):
+        import collections
+        logging.Handler.__init__(self)
+        self.records = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.records.append(record)
 
-def setuplogging(loglevel, printtostdout, logfile):
+    def write(self, logfile, max_bytes):
+        if not self.records:
+            return
+        from logging.handlers import RotatingFileHandler
+        fh = RotatingFileHandler(logfile, maxBytes=max_bytes, backupCount=1)
+        fh.setFormatter(self.formatter)
+        try:
+            while self.records:
+                fh.handle(self.records.popleft())
+        finally:
+            fh.close()
+
+
+def setuplogging(loglevel, printtostdout, logfile, logmode='file', buffersize=1000):
     # pretty self explanatory. Takes options and sets up logging.
     # print "starting up with loglevel",loglevel,logging.getLevelName(loglevel)
-    logging.basicConfig(filename=logfile,
-                        filemode='w', level=loglevel,
-                        format='%(asctime)s:%(levelname)s:%(message)s')
+    global logbuffer
+    if logmode == 'buffer':
+        logbuffer = RingBufferHandler(buffersize)
+        logbuffer.setFormatter(logging.Formatter(logformat))
+        logger = logging.getLogger()
+        logger.setLevel(loglevel)
+        logger.addHandler(logbuffer)
+    else:
+        logging.basicConfig(filename=logfile,
+                            filemode='w', level=loglevel,
+                            format=logformat)
     if printtostdout:
         soh = logging.StreamHandler(sys.stdout)
         soh.setLevel(loglevel)
@@ -48,9 +166,125 @@ def setuplogging(loglevel, printtostdout, logfile):
         logger.addHandler(soh)
 
 
+def flush_logbuffer(options):
+    # write out whatever the in-memory log buffer is holding, if anything
+    if logbuffer is not None:
+        try:
+            logbuffer.write(options.logfile, int(options.log_max_bytes))
+        except (IOError, OSError) as e:
+            sys.stderr.write("Unable to write log file '%s': %s\n" %
+                             (options.logfile, str(e)))
+
+
+class PhaseTimer():
+    '''
+    Adds up the time spent in each named phase of a run for
+    --instrument, on the best clock available (perf_counter on python
+    3.3+, time.time before that).
+    '''
+
+    def __init__(self):
+        self.clock = getattr(time, 'perf_counter', time.time)
+        self.started = self.clock()
+        self.names = []
+        self.seconds = {}
+        self.current = None
+        self.current_started = None
+
+    def start(self, name):
+        # ends the running phase
+        now = self.clock()
+        if self.current is not None:
+            self.seconds[self.current] += now - self.current_started
+        if name not in self.seconds:
+            self.names.append(name)
+            self.seconds[name] = 0.0
+        self.current = name
+        self.current_started = now
+
+    def phases(self):
+        # [(name, seconds)] in the order phases first ran, running one included
+        self.start(self.current or 'startup')
+        return [(name, self.seconds[name]) for name in self.names]
+
+    def duration(self):
+        return self.clock() - self.started
+
+
+def phase(name):
+    # marks the start of a phase for --instrument, next to free otherwise
+    if phasetimer is not None:
+        phasetimer.start(name)
+
+
+def start_instrumentation(options):
+    '''
+    Starts the phase timer for --instrument or --cprofile_dump. Returns
+    a running cProfile profiler for --cprofile_dump, otherwise None.
+    '''
+    global phasetimer
+    if not (options.instrument or options.cprofile_dump):
+        return None
+    phasetimer = PhaseTimer()
+    if options.cprofile_dump:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    return None
+
+
+def stop_instrumentation(options, profiler):
+    '''
+    Writes the profile to --cprofile_dump when the run took longer than
+    --latency_budget_ms, or always with no budget.
+    '''
+    profiler.disable()
+    duration = phasetimer.duration()
+    budget = float(options.latency_budget_ms) / 1000
+    if duration > budget:
+        logging.warning("Check took %.3fs, writing profile to '%s'",
+                        duration, options.cprofile_dump)
+        profiler.dump_stats(options.cprofile_dump)
+
+
+def instrumentation_perfdata(options):
+    '''
+    Returns the --instrument PerfChunks: check_duration, one
+    check_phase_<name> per phase and the check's own peak RSS and CPU
+    time where the resource module exists.
+    '''
+    if phasetimer is None or not options.instrument:
+        return []
+    perfdata = []
+    budget = float(options.latency_budget_ms) / 1000
+    for name, seconds in phasetimer.phases():
+        perfdata.append(PerfChunk(stringname='check_phase_' + name,
+                                  value='%.6f' % seconds, unit='s'))
+    duration = phasetimer.duration()
+    if budget and duration > budget:
+        logging.warning("Check took %.3fs, over the %.3fs latency budget",
+                        duration, budget)
+    perfdata.insert(0, PerfChunk(stringname='check_duration', value='%.6f' % duration,
+                                 unit='s', warn=budget or ''))
+    try:
+        import resource
+    except ImportError:
+        return perfdata
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is kB on linux, bytes on darwin
+    maxrss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    perfdata.append(PerfChunk(stringname='check_maxrss', value=maxrss, unit='B'))
+    perfdata.append(PerfChunk(stringname='check_cpu', unit='s',
+                              value='%.6f' % (usage.ru_utime + usage.ru_stime)))
+    return perfdata
+
+
 def execute_command(commandstring):
+    import subprocess
     try:
-        output = subprocess.Popen(commandstring, stdout=subprocess.PIPE)
+        output = subprocess.Popen(commandstring, stdout=subprocess.PIPE,
+                                  universal_newlines=True)
         return(output)
     except Exception as e:
         msg = "Exception calling command: '%s' , Exception: %s" % (
@@ -59,109 +293,50 @@ def execute_command(commandstring):
         return(msg)
 
 
-class Test_crit_warn(unittest.TestCase):
-
-    def test_all_good(self):
-        # MemoryState(total,used,free,shared,buffcache,swap_total,swap_used,swap_free,available)
-        m = MemoryState(8000, 100, 100, 1, 1, 2000, 0, 2000, None)
-        mem_warn_value = 90.00
-        mem_crit_value = 95.00
-        swap_warn_value = 80.00
-        swap_crit_value = 90.00
-        return_value = m.within_critwarn_range(
-            mem_warn_value, mem_crit_value, swap_warn_value, swap_crit_value)
-        expected_value = 0
-        self.assertEqual(return_value, expected_value)
-
-    def test_mem_warn(self):
-        # MemoryState(total,used,free,shared,buffcache,swap_total,swap_used,swap_free,available)
-        m = MemoryState(8000, 7300, 100, 1, 1, 2000, 0, 2000, None)
-        mem_warn_value = 90.00
-        mem_crit_value = 95.00
-        swap_warn_value = 80.00
-        swap_crit_value = 90.00
-        return_value = m.within_critwarn_range(
-            mem_warn_value, mem_crit_value, swap_warn_value, swap_crit_value)
-        expected_value = 1
-        self.assertEqual(return_value, expected_value)
-
-    def test_mem_crit(self):
-        # MemoryState(total,used,free,shared,buffcache,swap_total,swap_used,swap_free,available)
-        m = MemoryState(8000, 7900, 100, 1, 1, 2000, 0, 2000, None)
-        mem_warn_value = 90.00
-        mem_crit_value = 95.00
-        swap_warn_value = 80.00
-        swap_crit_value = 90.00
-        return_value = m.within_critwarn_range(
-            mem_warn_value, mem_crit_value, swap_warn_value, swap_crit_value)
-        expected_value = 2
-        self.assertEqual(return_value, expected_value)
-
-    def test_swap_warn(self):
-        # MemoryState(total,used,free,shared,buffcache,swap_total,swap_used,swap_free,available)
-        m = MemoryState(8000, 2000, 6000, 1, 1, 2000, 1800, 200, None)
-        mem_warn_value = 90.00
-        mem_crit_value = 95.00
-        swap_warn_value = 80.00
-        swap_crit_value = 90.00
-        return_value = m.within_critwarn_range(
-            mem_warn_value, mem_crit_value, swap_warn_value, swap_crit_value)
-        expected_value = 1
-        self.assertEqual(return_value, expected_value)
-
-    def test_swap_crit(self):
-        # MemoryState(total,used,free,shared,buffcache,swap_total,swap_used,swap_free,available)
-        m = MemoryState(8000, 2000, 6000, 1, 1, 2000, 1900, 200, None)
-        mem_warn_value = 90.00
-        mem_crit_value = 95.00
-        swap_warn_value = 80.00
-        swap_crit_value = 90.00
-        return_value = m.within_critwarn_range(
-            mem_warn_value, mem_crit_value, swap_warn_value, swap_crit_value)
-        expected_value = 2
-        self.assertEqual(return_value, expected_value)
-
-    def test_swap_trumps_mem(self):
-        # MemoryState(total,used,free,shared,buffcache,swap_total,swap_used,swap_free,available)
-        m = MemoryState(8000, 7300, 6000, 1, 1, 2000, 1900, 200, None)
-        mem_warn_value = 90.00
-        mem_crit_value = 95.00
-        swap_warn_value = 80.00
-        swap_crit_value = 90.00
-        return_value = m.within_critwarn_range(
-            mem_warn_value, mem_crit_value, swap_warn_value, swap_crit_value)
-        expected_value = 2
-        self.assertEqual(return_value, expected_value)
-
-    def test_mem_trumps_swap(self):
-        # MemoryState(total,used,free,shared,buffcache,swap_total,swap_used,swap_free,available)
-        m = MemoryState(8000, 7900, 6000, 1, 1, 2000, 100, 200, None)
-        mem_warn_value = 90.00
-        mem_crit_value = 95.00
-        swap_warn_value = 80.00
-        swap_crit_value = 90.00
-        return_value = m.within_critwarn_range(
-            mem_warn_value, mem_crit_value, swap_warn_value, swap_crit_value)
-        expected_value = 2
-        self.assertEqual(return_value, expected_value)
-
-    def test_bad_warn_value_returns_unknown(self):
-        # MemoryState(total,used,free,shared,buffcache,swap_total,swap_used,swap_free,available)
-        m = MemoryState(8000, 7900, 6000, 1, 1, 2000, 100, 200, None)
-        mem_warn_value = '90%'
-        mem_crit_value = 95.00
-        swap_warn_value = 80.00
-        swap_crit_value = 90.00
-        return_value = m.within_critwarn_range(
-            mem_warn_value, mem_crit_value, swap_warn_value, swap_crit_value)
-        expected_value = 3
-        self.assertEqual(return_value, expected_value)
-
-
-class MemoryState():
+def read_procfile(path, bufsize=65536):
+    '''
+    Reads a /proc or /sys file with as few syscalls as possible. Small
+    files like /proc/meminfo come back in a single read().
+    '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        data = os.read(fd, bufsize)
+        if len(data) == bufsize:
+            chunks = [data]
+            while True:
+                chunk = os.read(fd, bufsize)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            data = data[:0].join(chunks)
+    finally:
+        os.close(fd)
+    if not isinstance(data, str):
+        data = data.decode('ascii', 'replace')
+    return data
+
+
+class MemoryState(object):
     '''
     Holds state of memory regardless of the free type
+
+    Slotted so the daemon, --samples and --fleet can make lots of them
+    cheaply. available, the percentages and their strings and the MB
+    figures are worked out the first time they're read and then kept,
+    so treat the byte counts as read only after that.
     '''
+    __slots__ = ('total', 'used', 'free', 'shared', 'buffcache',
+                 'swap_total', 'swap_used', 'swap_free',
+                 # filled in by the collector and the history trend when available
+                 'sampled_at', 'mem_exhaustion_seconds', 'swap_exhaustion_seconds',
+                 'pressure',
+                 # spread of the readings behind a --samples burst
+                 'samples',
+                 # meminfo_accounting() for --threshold_basis effective
+                 'accounting',
+                 # lazily derived, see the properties below
+                 '_available', '_mem_pct', '_swap_pct', '_mem_pct_str',
+                 '_swap_pct_str', '_mb')
 
     def __init__(self, total, used, free, shared, buffcache, swap_total, swap_used, swap_free, available):
         self.total = total
@@ -172,14 +347,77 @@ class MemoryState():
         self.swap_total = swap_total
         self.swap_used = swap_used
         self.swap_free = swap_free
-        if available is None:
-            self.available = self.determine_available()
-        else:
-            self.available = available
-        (self.mem_used_percentage,
-            self.mem_used_percentage_string,
-            self.swap_used_percentage,
-            self.swap_used_percentage_string) = self.determine_used_percentages()
+        self._available = available
+        self._mem_pct = None
+        self._swap_pct = None
+        self._mem_pct_str = None
+        self._swap_pct_str = None
+        self._mb = None
+        self.sampled_at = None
+        self.mem_exhaustion_seconds = None
+        self.swap_exhaustion_seconds = None
+        self.pressure = None
+        self.samples = None
+        self.accounting = None
+
+    @classmethod
+    def from_packed(cls, buffer, offset=0, count=None):
+        '''
+        Makes a list of MemoryStates from records packed back to back in
+        the snapshot body layout (SNAPSHOT_BODY: timestamp, then
+        SNAPSHOT_FIELDS), setting sampled_at from the timestamp.
+        '''
+        size = SNAPSHOT_BODY.size
+        if count is None:
+            count = (len(buffer) - offset) // size
+        unpack_from = SNAPSHOT_BODY.unpack_from
+        states = []
+        for position in range(offset, offset + count * size, size):
+            record = unpack_from(buffer, position)
+            m = cls(*record[1:])
+            m.sampled_at = record[0]
+            states.append(m)
+        return states
+
+    @property
+    def available(self):
+        if self._available is None:
+            self._available = self.determine_available()
+        return self._available
+
+    @property
+    def mem_used_percentage(self):
+        if self._mem_pct is None:
+            try:
+                self._mem_pct = float(self.used) / self.total * 100
+            except ZeroDivisionError as er:
+                logging.critical("Exception: " + str(er))
+                return float(100)
+        return self._mem_pct
+
+    @property
+    def swap_used_percentage(self):
+        if self._swap_pct is None:
+            if self.swap_total != 0:
+                self._swap_pct = float(self.swap_used) / self.swap_total * 100
+            else:
+                self._swap_pct = float(0)
+        return self._swap_pct
+
+    @property
+    def mem_used_percentage_string(self):
+        if self._mem_pct_str is None:
+            self._mem_pct_str = "%.2f" % round(self.mem_used_percentage, 2)
+        return self._mem_pct_str
+
+    @property
+    def swap_used_percentage_string(self):
+        if self._swap_pct_str is None:
+            if self.swap_total != 0:
+                self._swap_pct_str = "%.2f" % round(self.swap_used_percentage, 2)
+            else:
+                self._swap_pct_str = '0.0'
+        return self._swap_pct_str
 
     def dumpself(self):
         msg = 'MemoryStatus\n'
@@ -204,85 +442,111 @@ class MemoryState():
         return available
 
     def determine_used_percentages(self):
-        logging.info("Entering determine_used_percentages()")
-        mem_used = float(100)
-        swap_used = float(100)
-        try:
-            mem_used = (float(self.used) / float(self.total)) * float(100)
-            mem_used_str = str("%.2f" % round(mem_used, 2))
-        except Exception as er:
-            logging.critical("Exception: " + str(er))
-        if self.swap_total != 0:
-            try:
-                swap_used = (float(self.swap_used) /
-                             float(self.swap_total)) * float(100)
-                swap_used_str = str("%.2f" % round(swap_used, 2))
-            except Exception as orf:
-                logging.critical("Exception: " + str(orf))
-        else:
-            swap_used = float(0)
-            swap_used_str = '0.0'
-        return mem_used, mem_used_str, swap_used, swap_used_str
+        # kept for callers from before the percentages became properties
+        return (self.mem_used_percentage, self.mem_used_percentage_string,
+                self.swap_used_percentage, self.swap_used_percentage_string)
 
-    def within_critwarn_range(self, mem_warn, mem_crit, swap_warn, swap_crit):
+    def within_critwarn_range(self, mem_warn, mem_crit, swap_warn, swap_crit,
+                              tte_warn=None, tte_crit=None,
+                              psi_warn=None, psi_crit=None, psi_metric='some_avg60'):
+        # tte_warn/tte_crit are optional time-to-exhaustion thresholds in
+        # seconds, checked against the history trend for memory and swap
+        # psi_warn/psi_crit are optional stall percentage thresholds for
+        # the psi_metric memory pressure average, UNKNOWN when it's missing
         # set returncode unknown until proven otherwise
         returncode_mem = 3
         returncode_swap = 3
+        returncode_tte = 3
+        returncode_psi = 3
         returncode = 3
         try:
-            logging.info("Entering within_crit_warn_range with rc %s" %
-                         str(returncode))
+            logging.info("Entering within_crit_warn_range with rc %s", returncode)
             logging.info(
-                "Entering within_crit_warn_range with mem_warn %s" % str(mem_warn))
+                "Entering within_crit_warn_range with mem_warn %s", mem_warn)
             logging.info(
-                "Entering within_crit_warn_range with mem_crit %s" % str(mem_crit))
+                "Entering within_crit_warn_range with mem_crit %s", mem_crit)
             logging.info(
-                "Entering within_crit_warn_range with swap_warn %s" % str(swap_warn))
+                "Entering within_crit_warn_range with swap_warn %s", swap_warn)
             logging.info(
-                "Entering within_crit_warn_range with swap_crit %s" % str(swap_crit))
+                "Entering within_crit_warn_range with swap_crit %s", swap_crit)
             mem_warn = float(mem_warn)
             mem_crit = float(mem_crit)
             swap_warn = float(swap_warn)
             swap_crit = float(swap_crit)
-            if self.swap_used_percentage > swap_warn:
+            # each property lookup is a call now, read them once
+            swap_used_percentage = self.swap_used_percentage
+            mem_used_percentage = self.mem_used_percentage
+            if swap_used_percentage > swap_warn:
                 returncode_swap = 1
             else:
                 returncode_swap = 0
-            if self.swap_used_percentage > swap_crit:
+            if swap_used_percentage > swap_crit:
                 returncode_swap = 2
 
-            if self.mem_used_percentage > mem_warn:
+            if mem_used_percentage > mem_warn:
                 returncode_mem = 1
             else:
                 returncode_mem = 0
-            if self.mem_used_percentage > mem_crit:
+            if mem_used_percentage > mem_crit:
                 returncode_mem = 2
 
-            if returncode_mem == 1 or returncode_swap == 1:
+            exhaustion = [t for t in (self.mem_exhaustion_seconds,
+                                      self.swap_exhaustion_seconds) if t is not None]
+            returncode_tte = 0
+            if exhaustion and tte_warn is not None and min(exhaustion) < float(tte_warn):
+                returncode_tte = 1
+            if exhaustion and tte_crit is not None and min(exhaustion) < float(tte_crit):
+                returncode_tte = 2
+
+            stall = None
+            if self.pressure is not None:
+                stall = self.pressure.get(psi_metric)
+            returncode_psi = 0
+            if stall is None and (psi_warn is not None or psi_crit is not None):
+                returncode_psi = 3
+            if stall is not None and psi_warn is not None and stall > float(psi_warn):
+                returncode_psi = 1
+            if stall is not None and psi_crit is not None and stall > float(psi_crit):
+                returncode_psi = 2
+
+            returncodes = (returncode_mem, returncode_swap,
+                           returncode_tte, returncode_psi)
+            if 1 in returncodes:
                 returncode = 1
-            if returncode_mem == 2 or returncode_swap == 2:
+            if 2 in returncodes:
                 returncode = 2
 
-            if returncode_swap == 0 and returncode_mem == 0:
+            if returncodes == (0, 0, 0, 0):
                 returncode = 0
 
             logging.info(
-                "Leaving within_crit_warn_range with rc_mem %s" % str(returncode_mem))
+                "Leaving within_crit_warn_range with rc_mem %s", returncode_mem)
+            logging.info(
+                "Leaving within_crit_warn_range with rc_swap %s", returncode_swap)
             logging.info(
-                "Leaving within_crit_warn_range with rc_swap %s" % str(returncode_swap))
-            logging.info("Leaving within_crit_warn_range with rc %s" %
-                         str(returncode))
+                "Leaving within_crit_warn_range with rc_tte %s", returncode_tte)
+            logging.info(
+                "Leaving within_crit_warn_range with rc_psi %s", returncode_psi)
+            logging.info("Leaving within_crit_warn_range with rc %s", returncode)
         except Exception as e:
             logging.info(
-                "Exception warn/crit as floats or warn/crit compare error: %s" % str(e))
+                "Exception warn/crit as floats or warn/crit compare error: %s", e)
         return returncode
 
     def convert_bytes_to_mb(self):
         # takes mem total and used and returns values in MB
-        total = self.total / 1024 / 1024
-        used = self.used / 1024 / 1024
-        swap_used = self.swap_used / 1024 / 1024
-        return(total, used, swap_used)
+        if self._mb is None:
+            total = self.total // 1024 // 1024
+            used = self.used // 1024 // 1024
+            swap_used = self.swap_used // 1024 // 1024
+            self._mb = (total, used, swap_used)
+        return self._mb
+
+
+def version_tuple(version):
+    # '3.3.10' -> (3, 3, 10) so versions compare numerically
+    import re
+    return tuple(int(part) for part in re.findall(r'\d+', version))
 
 
 def process_results(free_version, r):
@@ -310,7 +574,7 @@ def process_results(free_version, r):
             used = int(clean_chunks[2])
             free = int(clean_chunks[3])
             shared = int(clean_chunks[4])
-            if LooseVersion(free_version) > LooseVersion('3.3.9'):
+            if version_tuple(free_version) > (3, 3, 9):
                 buffcache = int(clean_chunks[5])
                 available = int(clean_chunks[6])
             else:
@@ -324,19 +588,323 @@ def process_results(free_version, r):
             swap_total = int(clean_chunks[1])
             swap_used = int(clean_chunks[2])
             swap_free = int(clean_chunks[3])
+    phase('memorystate')
     m = MemoryState(total, used, free, shared, buffcache,
                     swap_total, swap_used, swap_free, available)
     return m
 
 
-def main(options):
-    ''' The main() method. Program starts here.
+def parse_meminfo(data, fields=MEMINFO_FIELDS, sep=':', prefix=''):
+    '''
+    Pulls the requested fields out of /proc/meminfo formatted text and
+    returns them as a dict of ints. Values reported in kB are converted
+    to bytes. Only the wanted lines are looked up so the rest of the
+    file is never split apart. Fields missing from the text are left out.
+    Pass sep=' ' for 'key value' files like cgroup memory.stat, and
+    prefix='Node 0 ' for the per node meminfo files in sysfs.
+    '''
+    values = {}
+    for field in fields:
+        key = prefix + field + sep
+        start = data.find('\n' + key) + 1
+        if not start and not data.startswith(key):
+            continue
+        start += len(key)
+        end = data.find('\n', start)
+        if end < 0:
+            end = len(data)
+        value = data[start:end].rstrip()
+        if value.endswith('kB'):
+            values[field] = int(value[:-2]) * 1024
+        else:
+            values[field] = int(value)
+    return values
+
+
+def meminfo_usage(meminfo, formula='available'):
+    # (used, buffcache, available) without building a MemoryState
+    total = meminfo['MemTotal']
+    free = meminfo['MemFree']
+    buffcache = meminfo['Buffers'] + meminfo['Cached']
+    if formula != 'buffers':
+        # procps before 3.3.10 left the reclaimable slab out of the cache
+        buffcache += meminfo.get('SReclaimable', 0)
+    available = meminfo.get('MemAvailable')
+    if available is None or formula in ('buffcache', 'buffers'):
+        used = total - free - buffcache
+    else:
+        used = total - available
+    if used < 0:
+        used = total - free
+    return used, buffcache, available
+
+
+def process_meminfo(meminfo, formula='available'):
+    '''
+    Make a MemoryState object from parsed /proc/meminfo values using
+    the same arithmetic as procps-ng 'free -b':
+        buff/cache = Buffers + Cached + SReclaimable
+        used       = MemTotal - MemAvailable              (4.x)
+        used       = MemTotal - MemFree - buff/cache      (3.3.10 - 3.3.17)
+    formula 'buffcache' picks the older definition, which kernels
+    without MemAvailable fall back to as well. 'buffers' matches the
+    '-/+ buffers/cache' line of procps 3.3.9 and older, whose cache is
+    only Buffers + Cached.
+    '''
+    total = meminfo['MemTotal']
+    free = meminfo['MemFree']
+    used, buffcache, available = meminfo_usage(meminfo, formula)
+    swap_total = meminfo['SwapTotal']
+    swap_free = meminfo['SwapFree']
+    swap_used = swap_total - swap_free
+    phase('memorystate')
+    m = MemoryState(total, used, free, meminfo.get('Shmem', 0), buffcache,
+                    swap_total, swap_used, swap_free, available)
+    m.accounting = meminfo_accounting(meminfo)
+    return m
+
+
+def meminfo_accounting(meminfo):
+    '''
+    Works out the effective memory figures from parsed /proc/meminfo:
+        effective_total     = MemTotal - Hugetlb
+        effective_available = MemAvailable
+    The hugetlb pool is reserved up front and can't be handed to
+    anything else, used or not, so it's taken out of both sides rather
+    than counted as used. MemAvailable already includes the reclaimable
+    page cache and slab (SReclaimable). Kernels without it fall back to
+    MemFree + buff/cache. The zswap pool is RAM in use and stays in used.
+    The other figures are only reported.
+    '''
+    used, buffcache, available = meminfo_usage(meminfo)
+    if available is None:
+        available = meminfo['MemTotal'] - used
+    pagesize = meminfo.get('Hugepagesize', 0)
+    hugetlb = meminfo.get('Hugetlb')
+    if hugetlb is None:
+        # before 4.16 only the default page size pool is reported
+        hugetlb = meminfo.get('HugePages_Total', 0) * pagesize
+    effective_total = max(meminfo['MemTotal'] - hugetlb, 0)
+    return {'sreclaimable': meminfo.get('SReclaimable', 0),
+            'hugetlb': hugetlb,
+            'hugepages_free': meminfo.get('HugePages_Free', 0) * pagesize,
+            'hugepages_rsvd': meminfo.get('HugePages_Rsvd', 0) * pagesize,
+            'zswap': meminfo.get('Zswap', 0),
+            'zswapped': meminfo.get('Zswapped', 0),
+            'effective_total': effective_total,
+            'effective_available': min(max(available, 0), effective_total)}
+
+
+def collect_zram(root=SYS_BLOCK_PATH):
+    '''
+    Sums the original size, compressed size and RAM used of every zram
+    device under root from its mm_stat. Hosts without zram get zeros.
+    '''
+    totals = dict((field, 0) for field in ZRAM_MM_STAT_FIELDS)
+    try:
+        names = os.listdir(root)
+    except (IOError, OSError):
+        return totals
+    for name in names:
+        if not name.startswith('zram'):
+            continue
+        try:
+            values = read_procfile(os.path.join(root, name, 'mm_stat')).split()
+        except (IOError, OSError) as e:
+            logging.info("Unable to read zram stats of '%s': %s", name, e)
+            continue
+        for field, value in zip(ZRAM_MM_STAT_FIELDS, values):
+            totals[field] += int(value)
+    return totals
+
+
+def collect_accounting(options, memstats):
+    '''
+    Fills in memstats.accounting for --threshold_basis effective. The
+    procfs collector already parsed it from its single meminfo read;
+    'free' output and daemon snapshots don't carry it, so meminfo is
+    read once more for those. zram is read from sysfs either way.
+    '''
+    if memstats.accounting is None:
+        if memstats.samples:
+            # one more reading would stand in for the whole burst
+            raise ValueError("--samples weren't collected for --threshold_basis effective")
+        if options.fixture:
+            logging.info("No meminfo accounting in fixture '%s'", options.fixture)
+            return
+        memstats.accounting = meminfo_accounting(parse_meminfo(
+            read_procfile(MEMINFO_PATH), MEMINFO_FIELDS + ACCOUNTING_FIELDS))
+    # a new dict, the server shares accounting between copies of its sample
+    memstats.accounting = dict(memstats.accounting, **collect_zram())
+
+
+def effective_state(memstats):
+    '''
+    Returns a MemoryState measured against the effective total and
+    available memory, for checking thresholds on. Swap, trend and
+    pressure are carried over unchanged.
+    '''
+    accounting = memstats.accounting
+    total = accounting['effective_total']
+    available = accounting['effective_available']
+    m = MemoryState(total, total - available, memstats.free, memstats.shared,
+                    memstats.buffcache, memstats.swap_total, memstats.swap_used,
+                    memstats.swap_free, available)
+    for name in ('sampled_at', 'mem_exhaustion_seconds',
+                 'swap_exhaustion_seconds', 'pressure', 'samples', 'accounting'):
+        setattr(m, name, getattr(memstats, name))
+    return m
+
+
+def accounting_perfdata(memstats):
+    # the effective figures and every component behind them
+    checked = effective_state(memstats)
+    perfdata = [PerfChunk(stringname='EFFECTIVE_USED', value=checked.used, unit='B'),
+                PerfChunk(stringname='EFFECTIVE_TOTAL', value=checked.total, unit='B'),
+                PerfChunk(stringname='EFFECTIVE_USED_PCT', unit='%',
+                          value=checked.mem_used_percentage_string)]
+    for name in ('sreclaimable', 'hugetlb', 'hugepages_free', 'hugepages_rsvd',
+                 'zswap', 'zswapped') + ZRAM_MM_STAT_FIELDS:
+        if name in memstats.accounting:
+            perfdata.append(PerfChunk(stringname=name.upper(), unit='B',
+                                      value=memstats.accounting[name]))
+    return perfdata
+
+
+def collect_meminfo(path=MEMINFO_PATH, formula='available'):
+    # one read of /proc/meminfo, no forks
+    phase('read_procfile')
+    data = read_procfile(path)
+    phase('parse_meminfo')
+    return process_meminfo(parse_meminfo(data, MEMINFO_FIELDS + ACCOUNTING_FIELDS),
+                           formula)
+
+
+class MeminfoSampler():
+    '''
+    Re-reads /proc/meminfo for --samples through a single descriptor,
+    seeking back to the start instead of opening the file every time.
+    '''
+
+    def __init__(self, path=MEMINFO_PATH, bufsize=65536):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.bufsize = bufsize
+
+    def read(self, fields=MEMINFO_FIELDS):
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        data = os.read(self.fd, self.bufsize)
+        if not isinstance(data, str):
+            data = data.decode('ascii', 'replace')
+        return parse_meminfo(data, fields)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def sample_statistic(values, statistic):
+    '''
+    Returns the p50, p95, max or mean of a sequence of readings.
+    Percentiles are nearest rank, so they're always a real reading.
+    '''
+    if statistic == 'mean':
+        return sum(values) / len(values)
+    ordered = sorted(values)
+    if statistic == 'max':
+        return ordered[-1]
+    rank = (int(statistic[1:]) * len(ordered) + 99) // 100
+    return ordered[max(rank, 1) - 1]
+
+
+def collect_burst(options, accounting=False):
     '''
+    --samples: takes N readings --interval ms apart into preallocated
+    arrays and returns a MemoryState whose used memory and swap are the
+    --statistic of those readings. The min/max/p95 used percentage
+    goes in memstats.samples. With accounting the effective used memory
+    is taken per reading too, and its statistic goes in
+    memstats.accounting, so that needs /proc/meminfo.
+    '''
+    from array import array
+    count = int(options.samples)
+    interval = float(options.interval) / 1000
+    used = array('d', [0.0]) * count
+    swap_used = array('d', [0.0]) * count
+    sampler = None
+    collector = select_collector(options)
+    if collector.name == 'procfs':
+        try:
+            sampler = MeminfoSampler(collector.path)
+        except (IOError, OSError) as e:
+            if options.collector == 'procfs':
+                raise
+            logging.info(
+                "Unable to read '%s', falling back to 'free': %s", MEMINFO_PATH, e)
+            collector = FreeCollector()
+    fields = MEMINFO_FIELDS
+    effective_used = None
+    if accounting:
+        if sampler is None:
+            raise ValueError("--threshold_basis effective with --samples needs '%s'"
+                             % MEMINFO_PATH)
+        fields = MEMINFO_FIELDS + ACCOUNTING_FIELDS
+        effective_used = array('d', [0.0]) * count
+    sampled_at = time.time()
+    try:
+        for i in range(count):
+            if i:
+                delay = sampled_at + i * interval - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            if sampler is not None:
+                meminfo = sampler.read(fields)
+                used[i] = meminfo_usage(meminfo, collector.formula)[0]
+                swap_used[i] = meminfo['SwapTotal'] - meminfo['SwapFree']
+                if effective_used is not None:
+                    totals = meminfo_accounting(meminfo)
+                    effective_used[i] = (totals['effective_total'] -
+                                         totals['effective_available'])
+            else:
+                last = collector.collect()
+                used[i] = last.used
+                swap_used[i] = last.swap_used
+    finally:
+        if sampler is not None:
+            sampler.close()
+    if sampler is not None:
+        last = process_meminfo(meminfo, collector.formula)
+
+    mem = int(sample_statistic(used, options.statistic))
+    swap = int(sample_statistic(swap_used, options.statistic))
+    memstats = MemoryState(last.total, mem, last.free, last.shared,
+                           last.buffcache, last.swap_total, swap,
+                           last.swap_total - swap, last.total - mem)
+    memstats.sampled_at = sampled_at
+    percentages = [u * 100.0 / last.total for u in used]
+    memstats.samples = {'count': count, 'statistic': options.statistic,
+                        'min': min(percentages), 'max': max(percentages),
+                        'p95': sample_statistic(percentages, 'p95')}
+    if effective_used is not None:
+        # the components of the last reading, checked on the statistic
+        memstats.accounting = totals
+        totals['effective_available'] = totals['effective_total'] - int(
+            sample_statistic(effective_used, options.statistic))
+    return memstats
 
+
+def detect_free_version():
+    # the procps version from 'free -V', which decides the output format
+    phase('execute_command')
     version = execute_command(['free', '-V'])
     version_line = version.stdout.readline()
-    free_version = version_line.split()[-1]
+    return version_line.split()[-1]
+
 
+def collect_free(free_version=None):
+    # legacy collector, forks 'free' twice unless the version is known
+    if free_version is None:
+        free_version = detect_free_version()
+
+    phase('execute_command')
     results = execute_command(['free', '-b'])
 
     # default the type of the free command to 'standard'
@@ -348,162 +916,2150 @@ def main(options):
     for line in results.stdout.readlines():
         rlist.append(line)
 
-    logging.info("Output from 'free' command is of version: '%s'" % free_version)
+    logging.info("Output from 'free' command is of version: '%s'", free_version)
 
+    phase('process_results')
     memstats = process_results(free_version, rlist)
+    return memstats
 
-    logging.info(memstats.dumpself())
-
-    # take options and make smaller names
-    try:
-        mw = float(options.mem_warn_percentage)
-        mc = float(options.mem_crit_percentage)
-        sw = float(options.swap_warn_percentage)
-        sc = float(options.swap_crit_percentage)
-    except Exception as ar:
-        logging.info(
-            "Exception casting warn/crits as floats in main: %s" % str(ar))
 
-    if options.perfdata_only.lower() == 'no':
-        # pass in to check within ranges
-        nagios_rc = memstats.within_critwarn_range(mw, mc, sw, sc)
+def process_text(data, formula='available'):
+    '''
+    Makes a MemoryState from saved /proc/meminfo or 'free -b' output,
+    telling them apart by content. 'free' output from procps before
+    3.3.10 is recognised by its '-/+ buffers/cache' line. formula only
+    applies to meminfo, 'free' output has its own used.
+    '''
+    if 'MemTotal:' in data:
+        return process_meminfo(parse_meminfo(data, MEMINFO_FIELDS + ACCOUNTING_FIELDS),
+                               formula)
+    if '-/+ buffers/cache' in data:
+        free_version = FREE_OLD_FORMAT_VERSION
     else:
-        nagios_rc = 0
+        free_version = FREE_NEW_FORMAT_VERSION
+    return process_results(free_version, data.splitlines(True))
 
-    # sample current return string
-    # Memory: OK Total: 1840 MB - Used: -1310 MB - -71%
-    # used|TOTAL=1929613312;;;; USED=-1374179328;;;; CACHE=1510100992;;;;
-    # BUFFER=755486720;;;;
-    perfdata = []
-    pc_used = PerfChunk(stringname='USED', value=memstats.used, unit='B')
-    perfdata.append(pc_used)
 
-    pc_total = PerfChunk(stringname='TOTAL', value=memstats.total, unit='B')
-    perfdata.append(pc_total)
+class Collector():
+    '''
+    Base of the --collector backends. Subclasses define collect(), which
+    returns a MemoryState, and probe() says whether that works on this
+    host.
+    '''
+    name = None
 
-    pc_swap_used = PerfChunk(stringname='SWAP_USED',
-                             value=memstats.swap_used, unit='B')
-    perfdata.append(pc_swap_used)
+    def probe(self):
+        try:
+            self.collect()
+        except (IOError, OSError, KeyError, ValueError, IndexError) as e:
+            logging.info("Collector '%s' unavailable: %s", self.name, e)
+            return False
+        return True
 
-    pc_swap_total = PerfChunk(stringname='SWAP_TOTAL',
-                              value=memstats.swap_total, unit='B')
-    perfdata.append(pc_swap_total)
 
-    pc_mem_used_pct = PerfChunk(
-        stringname='MEM_USED_PCT', value=memstats.mem_used_percentage_string, unit='%')
-    perfdata.append(pc_mem_used_pct)
+class ProcfsCollector(Collector):
+    # one read of /proc/meminfo
+    name = 'procfs'
 
-    pc_swap_used_pct = PerfChunk(
-        stringname='SWAP_USED_PCT', value=memstats.swap_used_percentage_string, unit='%')
-    perfdata.append(pc_swap_used_pct)
+    def __init__(self, path=MEMINFO_PATH, formula='available'):
+        self.path = path
+        self.formula = formula
 
-    (mem_total_mb, mem_used_mb, swap_used_mb) = memstats.convert_bytes_to_mb()
-    msgstring = ("MEMORY:::: Total: %s MB - Used: %s MB - %s%% used --- "
-                 "SWAP:::: Used: %s MB - %s%% used" % (mem_total_mb,
-                                                       mem_used_mb,
-                                                       memstats.mem_used_percentage_string,
-                                                       swap_used_mb,
-                                                       memstats.swap_used_percentage_string)
-                 )
-    logging.info("Current RC = %s" % str(nagios_rc))
-    nm = NagiosReturnCode(returncode=nagios_rc, msgstring=msgstring)
-    nm.returnCode = nagios_rc
-    for pc in perfdata:
-        nm.perfChunkList.append(pc)
+    def collect(self):
+        return collect_meminfo(self.path, self.formula)
 
-    nm.genreturncode()
+
+class FreeCollector(Collector):
     '''
-    # add a perfdata chunk for total response time
-    pd = PerfChunk(stringname='response_time',value=response_time,unit='s')
-    # add it to the list of response perfdata
-    perfdata.append(pd)
-    # build your nagios message and tell it to be warn,crit,ok, etc.
-    # we'll start with a default of 1 which is warning
-    msgstring = "Elasticsearch Cluster Health API: " + str(status_code) + " " + str(status_string)
-    nm = NagiosReturnCode(returncode=1,msgstring=msgstring)
-    if status_code == 200:
-        nm.returnCode = 0
-    else:
-        nm.returnCode = 1
-    # append your perfdata chunks to the NagiosReturnCode object.
-    for perfchunk in perfdata:
-        nm.perfChunkList.append(perfchunk)
-    nm.genreturncode() # will raise a 'NagiosReturn' exception
+    Runs 'free -b'. free_version picks between the procps output
+    formats; when it isn't known 'free -V' is run first.
     '''
+    name = 'free'
 
-if __name__ == '__main__':
-    # unittest.main()
-    '''This main section is mostly for parsing arguments to the
-    script and setting up debugging'''
-    from optparse import OptionParser
-    '''set up an additional option group just for debugging parameters'''
-    from optparse import OptionGroup
-    usage = (
-        "%prog [--debug] [--printtostdout] [--logfile] [--version] [--help] [--samplefileoption]")
-    # set up the parser object
-    parser = OptionParser(usage, version='%prog ' + sversion)
-    parser.add_option('-w', '--mem_warn_percentage',
-                      type='string',
-                      help=(
-                          "Warning threshold percentage for used memory. Default='90'"),
-                      default='90')
-    parser.add_option('-c', '--mem_crit_percentage',
-                      type='string',
-                      help=(
-                          "Critical threshold percentage for used memory. Default='95'"),
-                      default='95')
-    parser.add_option('--swap_warn_percentage',
-                      type='string',
-                      help=(
-                          "Warning threshold percentage for used swap. Default='75'"),
-                      default='75')
-    parser.add_option('--swap_crit_percentage',
-                      type='string',
-                      help=(
-                          "Critical threshold percentage for used swap. Default='90'"),
-                      default='90')
-    parser.add_option('--perfdata_only',
-                      type='string',
-                      help=("Options are 'no' or 'yes'. When yes then check will always "
-                            "return OK. Default='no'"),
-                      default='no')
-    parser_debug = OptionGroup(parser, 'Debug Options')
-    parser_debug.add_option('-d', '--debug', type='string',
-                            help=('Available levels are CRITICAL (3), ERROR (2), '
-                                  'WARNING (1), INFO (0), DEBUG (-1)'),
-                            default='CRITICAL')
-    parser_debug.add_option('-p', '--printtostdout', action='store_true',
-                            default=False, help='Print all log messages to stdout')
-    parser_debug.add_option('-l', '--logfile', type='string', metavar='FILE',
-                            help=('Desired filename of log file output. Default '
-                                  'is "' + defaultlogfilename + '"'), default=defaultlogfilename)
-    # officially adds the debuggin option group
-    parser.add_option_group(parser_debug)
-    options, args = parser.parse_args()  # here's where the options get parsed
+    def __init__(self, free_version=None):
+        self.free_version = free_version
 
-    try:  # now try and get the debugging options
-        loglevel = getattr(logging, options.debug)
-    except AttributeError:  # set the log level
-        loglevel = {3: logging.CRITICAL,
-                    2: logging.ERROR,
-                    1: logging.WARNING,
-                    0: logging.INFO,
-                    -1: logging.DEBUG,
-                    }[int(options.debug)]
+    def probe(self):
+        try:
+            self.free_version = detect_free_version()
+        except (IOError, OSError, IndexError) as e:
+            logging.info("Collector '%s' unavailable: %s", self.name, e)
+            return False
+        return True
 
-    try:
-        open(options.logfile, 'w')  # try and open the default log file
-    except:
-        # print "Unable to open log file '%s' for writing." % options.logfile
-        logging.debug(
-            "Unable to open log file '%s' for writing." % options.logfile)
+    def collect(self):
+        return collect_free(self.free_version)
 
-    setuplogging(loglevel, options.printtostdout, options.logfile)
-    # now launch the main method. Have to do a try catch for Nagios
-    #  to properly see the application's exit return code.
 
+class CgroupCollector(Collector):
+    '''
+    Measures the cgroup v2 group this process runs in against its own
+    memory.max, for checks running inside a container.
+    '''
+    name = 'cgroup'
+
+    def __init__(self, root=defaultcgrouproot, self_cgroup='/proc/self/cgroup'):
+        self.root = root
+        self.self_cgroup = self_cgroup
+
+    def collect(self):
+        for line in read_procfile(self.self_cgroup).splitlines():
+            if line.startswith('0::'):
+                path = self.root.rstrip('/') + line[3:].rstrip('/')
+                break
+        else:
+            raise ValueError("No cgroup v2 entry in '%s'" % self.self_cgroup)
+        try:
+            swap_total = parse_meminfo(read_procfile(MEMINFO_PATH),
+                                       ('SwapTotal',)).get('SwapTotal', 0)
+        except (IOError, OSError):
+            swap_total = 0
+        try:
+            memstats = collect_cgroup(path, swap_total)
+        except (IOError, OSError) as e:
+            # the root cgroup has no memory.max at all
+            raise ValueError("Unable to read cgroup '%s': %s" % (path, e))
+        if memstats is None:
+            raise ValueError("cgroup '%s' has no memory limit" % path)
+        return memstats
+
+
+class FixtureCollector(Collector):
+    '''
+    Replays a saved /proc/meminfo or 'free -b' output from --fixture, so
+    the rest of the check can be run without touching the host.
+    '''
+    name = 'fixture'
+
+    def __init__(self, path, formula='available'):
+        self.path = path
+        self.formula = formula
+        self.data = None
+
+    def collect(self):
+        if self.data is None:
+            with open(self.path) as f:
+                self.data = f.read()
+        return process_text(self.data, self.formula)
+
+
+def probe_key():
+    '''
+    What a cached probe result depends on: the kernel release and the
+    path and mtime of the 'free' binary.
+    '''
+    free = ''
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        try:
+            mtime = os.stat(os.path.join(directory, 'free')).st_mtime
+        except OSError:
+            continue
+        free = '%s:%d' % (os.path.join(directory, 'free'), mtime)
+        break
+    return '%s|%s' % (os.uname()[2], free)
+
+
+def read_probe_cache(path):
+    # 'key=value' lines, an unreadable cache is the same as an empty one.
+    # so is one owned by another user, who could have planted any result
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except (IOError, OSError):
+        return {}
+    try:
+        if os.fstat(fd).st_uid != os.geteuid():
+            logging.info("Ignoring probe cache '%s' owned by another user", path)
+            return {}
+        data = os.read(fd, 65536).decode('utf-8', 'replace')
+    finally:
+        os.close(fd)
+    return dict(line.split('=', 1) for line in data.splitlines() if '=' in line)
+
+
+def write_probe_cache(path, values):
+    # written to a temp file and renamed so readers never see half of it
+    import tempfile
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.',
+                                   dir=os.path.dirname(path) or '.')
+        with os.fdopen(fd, 'w') as f:
+            f.write(''.join('%s=%s\n' % item for item in sorted(values.items())))
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        logging.info("Unable to write probe cache '%s': %s", path, e)
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def probe_procps_version():
+    # the installed procps version for used_formula(), '' without 'free'.
+    # kept for the life of the process, so the server only forks once
+    global procpsversion
+    if procpsversion is None:
+        try:
+            procpsversion = detect_free_version()
+        except (IOError, OSError, IndexError, AttributeError) as e:
+            logging.info("Unable to detect the procps version: %s", e)
+            procpsversion = ''
+    return procpsversion
+
+
+def used_formula(options, procps_version=None):
+    '''
+    Returns how used memory is worked out from /proc/meminfo: the
+    --used_formula, or for 'auto' what the installed procps 'free'
+    reports, so the procfs collector alerts at the same levels as 'free'
+    does. procps before FREE_NEW_FORMAT_VERSION gets 'buffers', before
+    USED_AVAILABLE_VERSION 'buffcache', newer or unknown versions get
+    'available'.
+    '''
+    if options.used_formula != 'auto':
+        return options.used_formula
+    if not procps_version or procps_version == 'none':
+        return 'available'
+    if version_tuple(procps_version) < version_tuple(FREE_NEW_FORMAT_VERSION):
+        return 'buffers'
+    if version_tuple(procps_version) < version_tuple(USED_AVAILABLE_VERSION):
+        return 'buffcache'
+    return 'available'
+
+
+def select_collector(options):
+    '''
+    Returns the Collector for options. 'auto' and 'free' are probed
+    once and the result cached in --probe_cache, keyed by probe_key(),
+    so later runs skip the probe. 'auto' prefers procfs. The procps
+    version behind the procfs used_formula() is cached the same way.
+    '''
+    if options.fixture:
+        return FixtureCollector(options.fixture, used_formula(options))
+    if options.collector == 'free-old':
+        return FreeCollector(FREE_OLD_FORMAT_VERSION)
+    if options.collector == 'free-new':
+        return FreeCollector(FREE_NEW_FORMAT_VERSION)
+    if options.collector == 'cgroup':
+        return CgroupCollector(options.cgroup_root)
+
+    key = probe_key()
+    cached = {}
+    if options.probe_cache:
+        cached = read_probe_cache(options.probe_cache)
+    if cached.get('key') != key:
+        cached = {}
+    # keep what the other modes found out under the same key
+    values = dict(cached, key=key)
+
+    collector = None
+    if options.collector == 'procfs' or (options.collector == 'auto' and
+                                         values.get('auto') == 'procfs'):
+        collector = ProcfsCollector()
+    elif options.collector == 'auto' and not values.get('auto'):
+        if ProcfsCollector().probe():
+            collector = ProcfsCollector()
+            values['auto'] = 'procfs'
+        else:
+            values['auto'] = 'free'
+    if collector is None:
+        collector = FreeCollector(values.get('free_version') or None)
+        if collector.free_version is None and collector.probe():
+            values['free_version'] = collector.free_version
+    else:
+        procps_version = values.get('free_version') or values.get('procps')
+        if options.used_formula == 'auto' and not procps_version:
+            procps_version = values['procps'] = probe_procps_version() or 'none'
+        collector.formula = used_formula(options, procps_version)
+    if options.probe_cache and values != cached:
+        write_probe_cache(options.probe_cache, values)
+    return collector
+
+
+class SnapshotWriter():
+    '''
+    Owns the memory mapped snapshot file for the --daemon sampler.
+    Each write() is wrapped in a sequence counter (seqlock) so readers
+    can detect and retry a half written sample without any locking.
+    The file is always created afresh and renamed into place, so a file
+    or symlink another user left at path is never written through.
+    '''
+
+    def __init__(self, path):
+        import mmap
+        import tempfile
+        self.path = path
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.',
+                                   dir=os.path.dirname(path) or '.')
+        try:
+            os.fchmod(fd, 0o644)
+            os.ftruncate(fd, SNAPSHOT_SIZE)
+            self.mm = mmap.mmap(fd, SNAPSHOT_SIZE)
+            os.rename(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+        finally:
+            os.close(fd)
+        self.mm[:SNAPSHOT_BODY_OFFSET] = b'\0' * SNAPSHOT_BODY_OFFSET
+        SNAPSHOT_HEADER.pack_into(self.mm, 0, SNAPSHOT_MAGIC, SNAPSHOT_VERSION)
+        self.seq = 0
+
+    def write(self, memstats, timestamp):
+        values = [int(getattr(memstats, f)) for f in SNAPSHOT_FIELDS]
+        self.seq += 1
+        SNAPSHOT_SEQ.pack_into(self.mm, SNAPSHOT_SEQ_OFFSET, self.seq)
+        SNAPSHOT_BODY.pack_into(self.mm, SNAPSHOT_BODY_OFFSET, timestamp, *values)
+        self.seq += 1
+        SNAPSHOT_SEQ.pack_into(self.mm, SNAPSHOT_SEQ_OFFSET, self.seq)
+
+    def close(self):
+        self.mm.close()
+
+
+def read_snapshot(path, max_age, retries=100):
+    '''
+    Maps the snapshot file written by the --daemon sampler and returns
+    a MemoryState built from it. Returns None if the file is missing,
+    not a snapshot, older than max_age seconds or kept changing while
+    being read, so the caller can fall back to live collection. So does
+    a file other users could have written, since it sits in /dev/shm.
+    '''
+    import mmap
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except (IOError, OSError):
+        return None
+    try:
+        st = os.fstat(fd)
+        if st.st_uid not in (os.geteuid(), 0) or st.st_mode & 0o022:
+            logging.info("Ignoring snapshot '%s' writable by another user", path)
+            return None
+        if st.st_size != SNAPSHOT_SIZE:
+            return None
+        mm = mmap.mmap(fd, SNAPSHOT_SIZE, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+    try:
+        if SNAPSHOT_HEADER.unpack_from(mm, 0) != (SNAPSHOT_MAGIC, SNAPSHOT_VERSION):
+            return None
+        for attempt in range(retries):
+            seq = SNAPSHOT_SEQ.unpack_from(mm, SNAPSHOT_SEQ_OFFSET)[0]
+            if seq == 0:
+                return None
+            if seq % 2:
+                continue
+            body = SNAPSHOT_BODY.unpack_from(mm, SNAPSHOT_BODY_OFFSET)
+            if SNAPSHOT_SEQ.unpack_from(mm, SNAPSHOT_SEQ_OFFSET)[0] == seq:
+                break
+        else:
+            logging.info("Snapshot '%s' kept changing while being read", path)
+            return None
+    finally:
+        mm.close()
+    age = time.time() - body[0]
+    if age > float(max_age) or age < -float(max_age):
+        logging.info("Snapshot '%s' is stale (%.1fs old)", path, age)
+        return None
+    m = MemoryState(*body[1:])
+    m.sampled_at = body[0]
+    return m
+
+
+class HistoryStore():
+    '''
+    Fixed size on-disk ring buffer of memory samples. Appends overwrite
+    the oldest record in place so they stay O(1) however long the
+    history gets, and reads unpack records straight out of the mmap.
+    A file with a different layout or capacity is started over.
+    '''
+
+    def __init__(self, path, capacity):
+        import mmap
+        import fcntl
+        self.capacity = capacity
+        size = HISTORY_HEADER.size + capacity * HISTORY_RECORD.size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # the same lock as append(), so two first runs can't both start over
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                header = os.read(self.fd, HISTORY_HEADER.size)
+                if (len(header) != HISTORY_HEADER.size or
+                        HISTORY_HEADER.unpack(header)[:3] !=
+                        (HISTORY_MAGIC, HISTORY_VERSION, capacity) or
+                        os.fstat(self.fd).st_size != size):
+                    logging.info("Starting new history in '%s'", path)
+                    os.ftruncate(self.fd, 0)
+                    os.ftruncate(self.fd, size)
+                    os.lseek(self.fd, 0, os.SEEK_SET)
+                    os.write(self.fd, HISTORY_HEADER.pack(
+                        HISTORY_MAGIC, HISTORY_VERSION, capacity, 0))
+                self.mm = mmap.mmap(self.fd, size)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        except:
+            os.close(self.fd)
+            raise
+
+    def count(self):
+        return HISTORY_COUNT.unpack_from(self.mm, HISTORY_COUNT_OFFSET)[0]
+
+    def append(self, timestamp, memstats):
+        # flock keeps concurrent check runs from claiming the same slot
+        import fcntl
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            count = self.count()
+            if count and self.record(count - 1)[0] >= timestamp:
+                # already have this sample, e.g. read from a daemon snapshot
+                return
+            HISTORY_RECORD.pack_into(
+                self.mm, HISTORY_HEADER.size + (count % self.capacity) * HISTORY_RECORD.size,
+                timestamp, memstats.used, memstats.total,
+                memstats.swap_used, memstats.swap_total)
+            HISTORY_COUNT.pack_into(self.mm, HISTORY_COUNT_OFFSET, count + 1)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def record(self, index):
+        return HISTORY_RECORD.unpack_from(
+            self.mm, HISTORY_HEADER.size + (index % self.capacity) * HISTORY_RECORD.size)
+
+    def since(self, timestamp):
+        # records newer than timestamp, oldest first
+        records = []
+        count = self.count()
+        for index in range(count - 1, max(count - self.capacity, 0) - 1, -1):
+            record = self.record(index)
+            if record[0] < timestamp:
+                break
+            records.append(record)
+        records.reverse()
+        return records
+
+    def exhaustion(self, window, now):
+        # (memory, swap) seconds until exhaustion at the trend over window
+        records = self.since(now - window)
+        mem = fit_exhaustion([(r[0], r[1], r[2]) for r in records])
+        swap = fit_exhaustion([(r[0], r[3], r[4]) for r in records])
+        return mem, swap
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+
+def fit_exhaustion(samples):
+    '''
+    Least squares fit of used over time for a list of (timestamp, used,
+    total). Returns the seconds until the latest used reaches total at
+    that rate, or None when usage isn't growing or there's too little data.
+    '''
+    n = len(samples)
+    if n < 2 or not samples[-1][2]:
+        return None
+    t0 = samples[0][0]
+    mean_t = sum(s[0] - t0 for s in samples) / float(n)
+    mean_used = sum(s[1] for s in samples) / float(n)
+    sxx = 0.0
+    sxy = 0.0
+    for t, used, total in samples:
+        dt = t - t0 - mean_t
+        sxx += dt * dt
+        sxy += dt * (used - mean_used)
+    if sxx == 0 or sxy <= 0:
+        return None
+    slope = sxy / sxx
+    return max(samples[-1][2] - samples[-1][1], 0) / slope
+
+
+def record_history(options, memstats):
+    '''
+    Appends memstats to --history_file and fills in its time to
+    exhaustion estimates from the trend over --trend_window.
+    '''
+    try:
+        store = HistoryStore(options.history_file, int(options.history_size))
+    except (IOError, OSError) as e:
+        logging.info("Unable to open history '%s': %s", options.history_file, e)
+        return
+    if memstats.sampled_at is None:
+        memstats.sampled_at = time.time()
+    try:
+        store.append(memstats.sampled_at, memstats)
+        (memstats.mem_exhaustion_seconds,
+            memstats.swap_exhaustion_seconds) = store.exhaustion(
+                float(options.trend_window), memstats.sampled_at)
+    finally:
+        store.close()
+
+
+def run_daemon(options):
+    '''
+    Resident sampler for --daemon. Collects memory stats every
+    --daemon_interval seconds and publishes them in the snapshot file
+    so check invocations don't have to collect anything themselves.
+    Runs in the foreground; leave daemonizing to the service manager.
+    '''
+    import signal
+    # exit through the finally below when the service manager stops us
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    interval = float(options.daemon_interval)
+    writer = SnapshotWriter(options.snapshot_file)
+    logging.info("Sampling every %ss into '%s'", interval, options.snapshot_file)
+    try:
+        while True:
+            started = time.time()
+            try:
+                memstats = collect_live(options)
+                writer.write(memstats, started)
+                if options.history_file:
+                    memstats.sampled_at = started
+                    record_history(options, memstats)
+            except Exception as e:
+                logging.error("Exception collecting sample: %s", e)
+                flush_logbuffer(options)
+            time.sleep(max(0, interval - (time.time() - started)))
+    finally:
+        writer.close()
+
+
+def collect_memory(options, accounting=None):
+    '''
+    Returns a MemoryState, preferring a fresh snapshot published by a
+    --daemon sampler and collecting live when there isn't one. A
+    --samples burst, a --fixture or an explicit --collector always
+    reads live. accounting, by default whether --threshold_basis is
+    effective, has a burst sample the effective figures as well.
+    '''
+    if int(options.samples) > 1:
+        if accounting is None:
+            accounting = options.threshold_basis == 'effective'
+        return collect_burst(options, accounting)
+    if options.snapshot_file and options.collector == 'auto' and not options.fixture:
+        memstats = read_snapshot(options.snapshot_file,
+                                 options.snapshot_max_age)
+        if memstats is not None:
+            return memstats
+    sampled_at = time.time()
+    memstats = collect_live(options)
+    memstats.sampled_at = sampled_at
+    return memstats
+
+
+def collect_live(options):
+    '''
+    Returns a MemoryState from the configured collector. In 'auto' mode
+    /proc/meminfo is used and the 'free' command is only a fallback.
+    '''
+    collector = select_collector(options)
+    try:
+        return collector.collect()
+    except (IOError, OSError, KeyError, ValueError) as e:
+        if options.collector != 'auto' or collector.name != 'procfs':
+            raise
+        logging.info(
+            "Unable to read '%s', falling back to 'free': %s", MEMINFO_PATH, e)
+    return collect_free()
+
+
+def parse_pressure(data):
+    '''
+    Parses PSI text from /proc/pressure/memory or a cgroup's
+    memory.pressure into a dict like {'some_avg10': 0.12, ...,
+    'some_total': 12345}. Averages are stall percentages and totals
+    are microseconds of stall since boot.
+    '''
+    pressure = {}
+    for line in data.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        kind = fields[0]
+        for field in fields[1:]:
+            name, value = field.split('=', 1)
+            if name == 'total':
+                pressure[kind + '_total'] = int(value)
+            else:
+                pressure[kind + '_' + name] = float(value)
+    return pressure
+
+
+def collect_pressure(path=PRESSURE_PATH):
+    # None on kernels without PSI (< 4.20 or booted with psi=0)
+    try:
+        return parse_pressure(read_procfile(path))
+    except (IOError, OSError, ValueError) as e:
+        logging.info("Unable to read memory pressure from '%s': %s", path, e)
+        return None
+
+
+def pressure_perfdata(pressure, prefix=''):
+    perfdata = []
+    for kind in ('some', 'full'):
+        for avg in ('avg10', 'avg60', 'avg300'):
+            if kind + '_' + avg in pressure:
+                perfdata.append(PerfChunk(
+                    stringname='%sPSI_%s_%s' % (prefix, kind.upper(), avg.upper()),
+                    value='%.2f' % pressure[kind + '_' + avg], unit='%'))
+        if kind + '_total' in pressure:
+            perfdata.append(PerfChunk(
+                stringname='%sPSI_%s_TOTAL' % (prefix, kind.upper()),
+                value=pressure[kind + '_total'], unit='us'))
+    return perfdata
+
+
+def psi_thresholds(options):
+    # (psi_warn, psi_crit, psi_metric) keyword arguments for within_critwarn_range
+    return {'psi_warn': options.psi_warn_percentage or None,
+            'psi_crit': options.psi_crit_percentage or None,
+            'psi_metric': options.psi_metric}
+
+
+def psi_enabled(options):
+    return bool(options.psi or options.psi_warn_percentage or
+                options.psi_crit_percentage)
+
+
+def list_subdirs(path):
+    # os.scandir saves a stat() per entry where available (python 3.5+)
+    if hasattr(os, 'scandir'):
+        return [e.path for e in os.scandir(path)
+                if e.is_dir(follow_symlinks=False)]
+    subdirs = []
+    for name in os.listdir(path):
+        subpath = os.path.join(path, name)
+        if os.path.isdir(subpath) and not os.path.islink(subpath):
+            subdirs.append(subpath)
+    return subdirs
+
+
+def collect_cgroup(path, host_swap_total):
+    '''
+    Make a MemoryState for a single cgroup v2 directory, measured
+    against its own memory.max. Used memory is memory.current minus
+    inactive_file, the same working set figure container runtimes use.
+    Swap is measured against memory.swap.max, or the host's swap when
+    that's unlimited. Returns None for cgroups without a memory limit.
+    '''
+    limit = read_procfile(path + '/memory.max').strip()
+    if limit == 'max':
+        return None
+    total = int(limit)
+    current = int(read_procfile(path + '/memory.current'))
+    stat = parse_meminfo(read_procfile(path + '/memory.stat'),
+                         CGROUP_STAT_FIELDS, sep=' ')
+    used = max(current - stat.get('inactive_file', 0), 0)
+    free = max(total - current, 0)
+    try:
+        swap_used = int(read_procfile(path + '/memory.swap.current'))
+        swap_total = read_procfile(path + '/memory.swap.max').strip()
+        swap_total = host_swap_total if swap_total == 'max' else int(swap_total)
+    except (IOError, OSError):
+        # kernel built without swap accounting
+        swap_used = 0
+        swap_total = 0
+    m = MemoryState(total, used, free, stat.get('shmem', 0), stat.get('file', 0),
+                    swap_total, swap_used, max(swap_total - swap_used, 0),
+                    max(total - used, 0))
+    return m
+
+
+def collect_cgroups(root, pressure=False):
+    '''
+    Walks a cgroup v2 hierarchy and returns a list of (name, MemoryState)
+    for every cgroup that has a memory limit. Names are relative to root.
+    Cgroups that disappear during the walk are skipped. With pressure
+    each state also gets the cgroup's memory.pressure when available.
+    '''
+    try:
+        host_swap_total = parse_meminfo(read_procfile(MEMINFO_PATH),
+                                        ('SwapTotal',)).get('SwapTotal', 0)
+    except (IOError, OSError):
+        host_swap_total = 0
+    states = []
+    skip = len(root.rstrip('/')) + 1
+    pending = list_subdirs(root)
+    while pending:
+        path = pending.pop()
+        try:
+            pending.extend(list_subdirs(path))
+            memstats = collect_cgroup(path, host_swap_total)
+        except (IOError, OSError, ValueError) as e:
+            logging.debug("Skipping cgroup '%s': %s", path, e)
+            continue
+        if memstats is None:
+            continue
+        if pressure:
+            try:
+                memstats.pressure = parse_pressure(
+                    read_procfile(path + '/memory.pressure'))
+            except (IOError, OSError, ValueError):
+                pass
+        states.append((path[skip:], memstats))
+    return states
+
+
+def collect_node(path, node):
+    '''
+    Make a MemoryState for one NUMA node from its sysfs meminfo. Nodes
+    have no MemAvailable, so used is MemTotal - MemFree - buff/cache
+    with buff/cache = FilePages + SReclaimable, the same fallback
+    process_meminfo uses on old kernels. Swap isn't per node and is
+    left at zero.
+    '''
+    meminfo = parse_meminfo(read_procfile(path + '/meminfo'),
+                            NODE_MEMINFO_FIELDS, prefix='Node %d ' % node)
+    total = meminfo['MemTotal']
+    free = meminfo['MemFree']
+    buffcache = meminfo.get('FilePages', 0) + meminfo.get('SReclaimable', 0)
+    used = max(total - free - buffcache, 0)
+    m = MemoryState(total, used, free, meminfo.get('Shmem', 0), buffcache,
+                    0, 0, 0, free + buffcache)
+    return m
+
+
+def collect_numa(root=defaultnoderoot):
+    '''
+    Returns a list of (name, MemoryState) for every NUMA node with
+    memory under root, in node order.
+    '''
+    nodes = []
+    for path in list_subdirs(root):
+        name = os.path.basename(path)
+        if name.startswith('node') and name[4:].isdigit():
+            nodes.append((int(name[4:]), name, path))
+    states = []
+    for node, name, path in sorted(nodes):
+        memstats = collect_node(path, node)
+        if memstats.total:
+            states.append((name, memstats))
+    return states
+
+
+def scan_top_processes(count, metric='rss', budget=None, proc=PROC_PATH):
+    '''
+    Scans /proc/[pid] and returns a list of (bytes, pid, name) for the
+    count processes using the most memory, largest first. 'rss' reads
+    statm, 'pss' reads smaps_rollup which is slower but fair to shared
+    pages. Only a count sized heap is kept, and the scan stops early
+    once budget seconds have been spent.
+    '''
+    import heapq
+    pagesize = os.sysconf('SC_PAGE_SIZE')
+    if budget:
+        deadline = time.time() + budget
+    heap = []
+    for n, pid in enumerate(os.listdir(proc)):
+        if not pid.isdigit():
+            continue
+        try:
+            if metric == 'pss':
+                value = parse_meminfo(read_procfile('%s/%s/smaps_rollup' % (proc, pid)),
+                                      ('Pss',)).get('Pss', 0)
+            else:
+                statm = read_procfile('%s/%s/statm' % (proc, pid))
+                value = int(statm.split(None, 2)[1]) * pagesize
+        except (IOError, OSError, ValueError, IndexError):
+            # gone already, or we aren't allowed to look
+            continue
+        if len(heap) < count:
+            heapq.heappush(heap, (value, pid))
+        elif value > heap[0][0]:
+            heapq.heapreplace(heap, (value, pid))
+        if budget and not n % 256 and time.time() > deadline:
+            logging.info("Process scan hit its %ss budget after %d entries", budget, n)
+            break
+    top = []
+    for value, pid in sorted(heap, reverse=True):
+        try:
+            name = read_procfile('%s/%s/comm' % (proc, pid)).strip()
+        except (IOError, OSError):
+            name = '?'
+        top.append((value, int(pid), name))
+    return top
+
+
+def load_replay_samples(path):
+    '''
+    Loads recorded samples for --replay as columns (used, total,
+    swap_used, swap_total), oldest first. Reads either a --history_file
+    ring or a CSV with a timestamp,total,used,swap_total,swap_used
+    header. Columns are numpy arrays when numpy is installed (the
+    history file is then mapped without parsing) and array('d')
+    otherwise. Samples with a zero total are dropped.
+    '''
+    import array
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    with open(path, 'rb') as f:
+        magic = f.read(len(HISTORY_MAGIC))
+    if magic == HISTORY_MAGIC:
+        # read only, unlike HistoryStore which starts a bad file over
+        import mmap
+        with open(path, 'rb') as f:
+            header = HISTORY_HEADER.unpack(f.read(HISTORY_HEADER.size))
+            capacity, count = header[2], header[3]
+            size = HISTORY_HEADER.size + capacity * HISTORY_RECORD.size
+            if header[1] != HISTORY_VERSION or os.fstat(f.fileno()).st_size != size:
+                raise ValueError("'%s' isn't a version %d history of %d records"
+                                 % (path, HISTORY_VERSION, capacity))
+            stored = min(count, capacity)
+            if numpy is not None:
+                records = numpy.memmap(f, mode='r', offset=HISTORY_HEADER.size,
+                                       shape=(capacity,), dtype=numpy.dtype(
+                                           [('timestamp', '<f8'), ('used', '<i8'),
+                                            ('total', '<i8'), ('swap_used', '<i8'),
+                                            ('swap_total', '<i8')]))[:stored]
+                if count > capacity:
+                    start = count % capacity
+                    records = numpy.concatenate((records[start:], records[:start]))
+                columns = [records[name].astype(numpy.float64) for name in
+                           ('used', 'total', 'swap_used', 'swap_total')]
+            else:
+                mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                try:
+                    rows = [HISTORY_RECORD.unpack_from(
+                        mm, HISTORY_HEADER.size + (index % capacity) * HISTORY_RECORD.size)
+                        for index in range(count - stored, count)]
+                finally:
+                    mm.close()
+                columns = [array.array('d', [r[i] for r in rows]) for i in (1, 2, 3, 4)]
+    else:
+        with open(path) as f:
+            names = [name.strip() for name in f.readline().split(',')]
+            if numpy is not None:
+                table = numpy.loadtxt(f, delimiter=',', dtype=numpy.float64, ndmin=2)
+                columns = [table[:, names.index(name)] for name in
+                           ('used', 'total', 'swap_used', 'swap_total')]
+            else:
+                indexes = [names.index(name) for name in
+                           ('used', 'total', 'swap_used', 'swap_total')]
+                columns = [array.array('d') for i in indexes]
+                for line in f:
+                    fields = line.split(',')
+                    for column, index in zip(columns, indexes):
+                        column.append(float(fields[index]))
+    if numpy is not None:
+        keep = columns[1] != 0
+        if not keep.all():
+            columns = [column[keep] for column in columns]
+    else:
+        keep = [i for i, total in enumerate(columns[1]) if total != 0]
+        if len(keep) != len(columns[1]):
+            columns = [array.array('d', [column[i] for i in keep]) for column in columns]
+    return columns
+
+
+def parse_range(value):
+    # '80:95:5' -> [80.0, 85.0, 90.0, 95.0], '90' -> [90.0]
+    parts = [float(part) for part in value.split(':')]
+    if len(parts) == 1:
+        return parts
+    start, stop, step = (parts + [1.0])[:3]
+    steps = int(round((stop - start) / step))
+    return [round(start + i * step, 10) for i in range(steps + 1)]
+
+
+def replay_evaluate(used, total, swap_used, swap_total, grid):
+    '''
+    Evaluates every (mem_warn, mem_crit, swap_warn, swap_crit) in grid
+    over the sample columns with the semantics of within_critwarn_range
+    and returns a list of (thresholds, warning, critical, flaps). warning
+    and critical count samples in that state, flaps counts state changes.
+    Uses numpy when the columns are numpy arrays.
+    '''
+    if hasattr(used, 'dtype'):
+        return replay_evaluate_numpy(used, total, swap_used, swap_total, grid)
+    mem_pct = [(u / t) * 100.0 for u, t in zip(used, total)]
+    swap_pct = [(u / t) * 100.0 if t != 0 else 0.0
+                for u, t in zip(swap_used, swap_total)]
+    results = []
+    for mw, mc, sw, sc in grid:
+        counts = [0, 0, 0]
+        flaps = 0
+        last = None
+        for mp, sp in zip(mem_pct, swap_pct):
+            rc = 2 if mp > mc else (1 if mp > mw else 0)
+            rc_swap = 2 if sp > sc else (1 if sp > sw else 0)
+            if rc_swap > rc:
+                rc = rc_swap
+            counts[rc] += 1
+            if last is not None and rc != last:
+                flaps += 1
+            last = rc
+        results.append(((mw, mc, sw, sc), counts[1], counts[2], flaps))
+    return results
+
+
+def replay_evaluate_numpy(used, total, swap_used, swap_total, grid):
+    # vectorized replay_evaluate, memory and swap states are computed
+    # once per threshold pair and shared across the grid
+    import numpy
+    mem_pct = (used / total) * 100.0
+    swap_pct = numpy.zeros_like(swap_used)
+    has_swap = swap_total != 0
+    swap_pct[has_swap] = (swap_used[has_swap] / swap_total[has_swap]) * 100.0
+
+    def states(pct, warn, crit):
+        return numpy.maximum((pct > warn).view(numpy.int8),
+                             (pct > crit).view(numpy.int8) * 2)
+    mem_states = {}
+    swap_states = {}
+    results = []
+    for mw, mc, sw, sc in grid:
+        if (mw, mc) not in mem_states:
+            mem_states[(mw, mc)] = states(mem_pct, mw, mc)
+        if (sw, sc) not in swap_states:
+            swap_states[(sw, sc)] = states(swap_pct, sw, sc)
+        rc = numpy.maximum(mem_states[(mw, mc)], swap_states[(sw, sc)])
+        counts = numpy.bincount(rc, minlength=3)
+        flaps = numpy.count_nonzero(rc[1:] != rc[:-1])
+        results.append(((mw, mc, sw, sc), int(counts[1]), int(counts[2]), int(flaps)))
+    return results
+
+
+def run_replay(options):
+    '''
+    --replay: prints how many WARNING/CRITICAL samples and state flaps
+    every combination of the threshold ranges would have produced over
+    the recorded samples. Thresholds take start:stop:step ranges here.
+    '''
+    import itertools
+    columns = load_replay_samples(options.replay)
+    grid = list(itertools.product(parse_range(options.mem_warn_percentage),
+                                  parse_range(options.mem_crit_percentage),
+                                  parse_range(options.swap_warn_percentage),
+                                  parse_range(options.swap_crit_percentage)))
+    started = time.time()
+    results = replay_evaluate(*(columns + [grid]))
+    logging.info("Replayed %d samples over %d thresholds in %.3fs",
+                 len(columns[0]), len(grid), time.time() - started)
+    print('# samples=%d' % len(columns[0]))
+    print('mem_warn\tmem_crit\tswap_warn\tswap_crit\twarning\tcritical\tflaps')
+    for thresholds, warning, critical, flaps in results:
+        print('%g\t%g\t%g\t%g\t%d\t%d\t%d' % (thresholds + (warning, critical, flaps)))
+    return 0
+
+
+def iter_fleet_jobs(source, stream=None):
+    '''
+    Yields (host, path, data) for every snapshot in a --fleet source
+    without reading them all up front. A directory gives one host per
+    file, named after the file. '-' reads JSON lines like
+    {"host": "web01", "data": "<meminfo or free -b output>"} from stream.
+    Lines that aren't such an object are yielded with neither path nor
+    data, so they come out as UNKNOWN rows.
+    '''
+    if source == '-':
+        import json
+        for number, line in enumerate(stream or sys.stdin, 1):
+            if not line.strip():
+                continue
+            host = 'line %d' % number
+            try:
+                snapshot = json.loads(line)
+                host = snapshot.get('host', host)
+                yield host, None, snapshot['data']
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                logging.error("Unable to read fleet snapshot from %s: %s", host, e)
+                yield host, None, None
+        return
+    if hasattr(os, 'scandir'):
+        entries = ((e.name, e.path) for e in os.scandir(source) if e.is_file())
+    else:
+        entries = ((name, os.path.join(source, name)) for name in os.listdir(source)
+                   if os.path.isfile(os.path.join(source, name)))
+    for name, path in entries:
+        if not name.startswith('.'):
+            yield os.path.splitext(name)[0], path, None
+
+
+def fleet_init(thresholds):
+    global fleetthresholds
+    fleetthresholds = thresholds
+
+
+def evaluate_snapshot(job):
+    '''
+    Parses and checks one --fleet snapshot against the thresholds set by
+    fleet_init(). Returns (host, returncode, mem_used_pct, swap_used_pct,
+    used, total), with None figures for snapshots that can't be parsed.
+    '''
+    host, path, data = job
+    (mw, mc, sw, sc), perfdata_only = fleetthresholds
+    if path is None and data is None:
+        return host, 3, None, None, None, None
+    try:
+        if data is None:
+            with open(path) as f:
+                data = f.read()
+        memstats = process_text(data)
+    except Exception as e:
+        logging.error("Unable to parse snapshot of '%s': %s", host, e)
+        return host, 3, None, None, None, None
+    if perfdata_only:
+        rc = 0
+    else:
+        rc = memstats.within_critwarn_range(mw, mc, sw, sc)
+    return (host, rc, memstats.mem_used_percentage, memstats.swap_used_percentage,
+            memstats.used, memstats.total)
+
+
+class Histogram():
+    '''
+    Fixed size histogram of percentages in 0.01% buckets, so --fleet
+    percentiles take the same memory for ten hosts or ten million.
+    '''
+
+    def __init__(self):
+        from array import array
+        self.buckets = array('l', [0]) * 10001
+        self.count = 0
+
+    def add(self, percentage):
+        self.buckets[min(max(int(round(percentage * 100)), 0), 10000)] += 1
+        self.count += 1
+
+    def percentile(self, pct):
+        # nearest rank, like sample_statistic
+        rank = max((pct * self.count + 99) // 100, 1)
+        seen = 0
+        for bucket, hits in enumerate(self.buckets):
+            seen += hits
+            if seen >= rank:
+                return bucket / 100.0
+        return None
+
+
+def run_fleet(options, out=None, stream=None):
+    '''
+    --fleet: checks every host snapshot from a directory or JSON lines
+    on stdin across a process pool. One row per host is written as
+    results arrive, then the count per state and fleet wide used memory
+    percentiles. Returns the worst state.
+    '''
+    out = out or sys.stdout
+    thresholds = (parse_thresholds(options), options.perfdata_only.lower() != 'no')
+    jobs = iter_fleet_jobs(options.fleet, stream)
+    workers = int(options.fleet_workers)
+    pool = None
+    if workers == 1:
+        fleet_init(thresholds)
+        results = (evaluate_snapshot(job) for job in jobs)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers or None, fleet_init, (thresholds,))
+        results = pool.imap_unordered(evaluate_snapshot, jobs,
+                                      int(options.fleet_chunk))
+    counts = {0: 0, 1: 0, 2: 0, 3: 0}
+    histogram = Histogram()
+    started = time.time()
+    out.write('host\tstate\tmem_used_pct\tswap_used_pct\tused\ttotal\n')
+    try:
+        for host, rc, mem_pct, swap_pct, used, total in results:
+            counts[rc] += 1
+            if mem_pct is None:
+                out.write('%s\t%s\t-\t-\t-\t-\n' % (host, RC_NAMES[rc]))
+                continue
+            histogram.add(mem_pct)
+            out.write('%s\t%s\t%.2f\t%.2f\t%d\t%d\n' %
+                      (host, RC_NAMES[rc], mem_pct, swap_pct, used, total))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    logging.info("Checked %d hosts in %.3fs", sum(counts.values()),
+                 time.time() - started)
+    out.write('# hosts=%d ok=%d warning=%d critical=%d unknown=%d\n' %
+              (sum(counts.values()), counts[0], counts[1], counts[2], counts[3]))
+    if histogram.count:
+        out.write('# mem_used_pct p50=%.2f p90=%.2f p99=%.2f max=%.2f\n' %
+                  tuple(histogram.percentile(p) for p in (50, 90, 99, 100)))
+    return max([rc for rc in counts if counts[rc]] or [0])
+
+
+def parse_thresholds(options):
+    # take options and make smaller names
+    try:
+        mw = float(options.mem_warn_percentage)
+        mc = float(options.mem_crit_percentage)
+        sw = float(options.swap_warn_percentage)
+        sc = float(options.swap_crit_percentage)
+    except Exception as ar:
+        logging.info(
+            "Exception casting warn/crits as floats in main: %s", ar)
+        # leave them as given so within_critwarn_range reports UNKNOWN
+        return (options.mem_warn_percentage, options.mem_crit_percentage,
+                options.swap_warn_percentage, options.swap_crit_percentage)
+    return mw, mc, sw, sc
+
+
+def main_cgroup(options):
+    '''
+    --mode cgroup: checks every memory limited cgroup under --cgroup_root
+    in one pass and returns the worst result, naming the worst offenders.
+    '''
+    import heapq
+    mw, mc, sw, sc = parse_thresholds(options)
+    psi = psi_enabled(options)
+    results = []
+    counts = {0: 0, 1: 0, 2: 0, 3: 0}
+    for name, memstats in collect_cgroups(options.cgroup_root, psi):
+        if options.perfdata_only.lower() == 'no':
+            rc = memstats.within_critwarn_range(mw, mc, sw, sc,
+                                                **psi_thresholds(options))
+        else:
+            rc = 0
+        counts[rc] = counts.get(rc, 0) + 1
+        results.append((rc, memstats.mem_used_percentage, name, memstats))
+
+    nagios_rc = worst_returncode([r[0] for r in results])
+    worst = heapq.nlargest(int(options.cgroup_top), results,
+                           key=lambda r: (RC_SEVERITY.index(r[0]), r[1]))
+    msgstring = ("CGROUPS:::: %d checked - %d critical - %d warning" %
+                 (len(results), counts[2], counts[1]))
+    if counts[3]:
+        msgstring += " - %d unknown" % counts[3]
+    if worst:
+        msgstring += " --- Worst: " + ", ".join(
+            "%s %s%% used" % (name, memstats.mem_used_percentage_string)
+            for rc, pct, name, memstats in worst)
+
+    perfdata = [PerfChunk(stringname='CGROUPS_CHECKED', value=len(results)),
+                PerfChunk(stringname='CGROUPS_WARNING', value=counts[1]),
+                PerfChunk(stringname='CGROUPS_CRITICAL', value=counts[2])]
+    for rc, pct, name, memstats in sorted(results, key=lambda r: r[2]):
+        perfdata.append(PerfChunk(stringname=name + '_USED',
+                                  value=memstats.used, unit='B',
+                                  maxx=memstats.total))
+        perfdata.append(PerfChunk(stringname=name + '_MEM_USED_PCT',
+                                  value=memstats.mem_used_percentage_string,
+                                  unit='%'))
+        if memstats.pressure and options.psi_metric in memstats.pressure:
+            perfdata.append(PerfChunk(
+                stringname='%s_PSI_%s' % (name, options.psi_metric.upper()),
+                value='%.2f' % memstats.pressure[options.psi_metric], unit='%'))
+
+    perfdata.extend(instrumentation_perfdata(options))
+    logging.info("Current RC = %s", nagios_rc)
+    code, text = format_result(nagios_rc, msgstring, perfdata)
+    raise NagiosReturn(text, code)
+
+
+def main_numa(options):
+    '''
+    --mode numa: checks every NUMA node against the memory thresholds.
+    The worst node decides the return code.
+    '''
+    mw, mc, sw, sc = parse_thresholds(options)
+    results = []
+    for name, memstats in collect_numa(options.node_root):
+        if options.perfdata_only.lower() == 'no':
+            rc = memstats.within_critwarn_range(mw, mc, sw, sc)
+        else:
+            rc = 0
+        results.append((name, rc, memstats))
+    if not results:
+        raise ValueError("No NUMA nodes with memory under '%s'" % options.node_root)
+
+    nagios_rc = max(r[1] for r in results)
+    nodes = []
+    for name, rc, memstats in results:
+        total, used, swap_used = memstats.convert_bytes_to_mb()
+        nodes.append("%s: %d of %d MB - %s%% used" %
+                     (name, used, total, memstats.mem_used_percentage_string))
+    msgstring = "NUMA:::: " + ", ".join(nodes)
+
+    perfdata = []
+    for name, rc, memstats in results:
+        perfdata.append(PerfChunk(stringname=name.upper() + '_USED',
+                                  value=memstats.used, unit='B',
+                                  maxx=memstats.total))
+        perfdata.append(PerfChunk(stringname=name.upper() + '_MEM_USED_PCT',
+                                  value=memstats.mem_used_percentage_string,
+                                  unit='%'))
+
+    perfdata.extend(instrumentation_perfdata(options))
+    logging.info("Current RC = %s", nagios_rc)
+    nm = NagiosReturnCode(returncode=nagios_rc, msgstring=msgstring)
+    nm.returnCode = nagios_rc
+    for pc in perfdata:
+        nm.perfChunkList.append(pc)
+
+    nm.genreturncode()
+
+
+def build_perfdata(memstats):
+    '''
+    Returns the list of PerfChunks describing a host MemoryState.
+    '''
+    # sample current return string
+    # Memory: OK Total: 1840 MB - Used: -1310 MB - -71%
+    # used|TOTAL=1929613312;;;; USED=-1374179328;;;; CACHE=1510100992;;;;
+    # BUFFER=755486720;;;;
+    perfdata = []
+    pc_used = PerfChunk(stringname='USED', value=memstats.used, unit='B')
+    perfdata.append(pc_used)
+
+    pc_total = PerfChunk(stringname='TOTAL', value=memstats.total, unit='B')
+    perfdata.append(pc_total)
+
+    pc_swap_used = PerfChunk(stringname='SWAP_USED',
+                             value=memstats.swap_used, unit='B')
+    perfdata.append(pc_swap_used)
+
+    pc_swap_total = PerfChunk(stringname='SWAP_TOTAL',
+                              value=memstats.swap_total, unit='B')
+    perfdata.append(pc_swap_total)
+
+    pc_mem_used_pct = PerfChunk(
+        stringname='MEM_USED_PCT', value=memstats.mem_used_percentage_string, unit='%')
+    perfdata.append(pc_mem_used_pct)
+
+    pc_swap_used_pct = PerfChunk(
+        stringname='SWAP_USED_PCT', value=memstats.swap_used_percentage_string, unit='%')
+    perfdata.append(pc_swap_used_pct)
+
+    if memstats.mem_exhaustion_seconds is not None:
+        perfdata.append(PerfChunk(stringname='MEM_TTE', unit='s',
+                                  value=int(memstats.mem_exhaustion_seconds)))
+    if memstats.swap_exhaustion_seconds is not None:
+        perfdata.append(PerfChunk(stringname='SWAP_TTE', unit='s',
+                                  value=int(memstats.swap_exhaustion_seconds)))
+    if memstats.pressure:
+        perfdata.extend(pressure_perfdata(memstats.pressure))
+    if memstats.samples:
+        for stat in ('min', 'max', 'p95'):
+            perfdata.append(PerfChunk(stringname='MEM_USED_PCT_' + stat.upper(),
+                                      value='%.2f' % memstats.samples[stat], unit='%'))
+    return perfdata
+
+
+def build_message(memstats):
+    # the human readable part of the host check output
+    (mem_total_mb, mem_used_mb, swap_used_mb) = memstats.convert_bytes_to_mb()
+    msgstring = ("MEMORY:::: Total: %s MB - Used: %s MB - %s%% used --- "
+                 "SWAP:::: Used: %s MB - %s%% used" % (mem_total_mb,
+                                                       mem_used_mb,
+                                                       memstats.mem_used_percentage_string,
+                                                       swap_used_mb,
+                                                       memstats.swap_used_percentage_string)
+                 )
+    return msgstring
+
+
+def render_openmetrics(memstats):
+    '''
+    Renders the host perfdata of memstats as OpenMetrics text. Byte,
+    percent and second units become name suffixes, microsecond counters
+    such as the PSI stall totals become seconds counters.
+    '''
+    lines = []
+    for pc in build_perfdata(memstats):
+        name = 'check_mem_' + pc.stringname.lower()
+        value = float(pc.value)
+        mtype = 'gauge'
+        sample = name
+        if pc.unit == 'B':
+            name = sample = name + '_bytes'
+        elif pc.unit == '%':
+            name = sample = name.replace('_pct', '') + '_percent'
+        elif pc.unit == 's':
+            name = sample = name + '_seconds'
+        elif pc.unit == 'us':
+            mtype = 'counter'
+            name = name.replace('_total', '') + '_seconds'
+            sample = name + '_total'
+            value = value / 1000000
+        lines.append('# TYPE %s %s' % (name, mtype))
+        lines.append('%s %r' % (sample, value))
+    if memstats.sampled_at is not None:
+        lines.append('# TYPE check_mem_sample_timestamp_seconds gauge')
+        lines.append('check_mem_sample_timestamp_seconds %r' % memstats.sampled_at)
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path, body):
+    # atomic replace so node_exporter never reads a half written file
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmppath, 'wb') as f:
+        f.write(body)
+    os.rename(tmppath, path)
+
+
+class MetricsCache():
+    '''
+    Holds the OpenMetrics rendering of the latest sample for --exporter.
+    It's rendered once per collection and every scrape is answered with
+    the same bytes, so scrapes never trigger a collection themselves.
+    '''
+
+    def __init__(self, options):
+        self.options = options
+        self.body = b''
+        self.collections = 0
+
+    def refresh(self):
+        memstats = collect_memory(self.options)
+        if psi_enabled(self.options):
+            memstats.pressure = collect_pressure()
+        body = render_openmetrics(memstats).encode('utf-8')
+        # a single reference swap, readers see either the old or new body
+        self.body = body
+        self.collections += 1
+        if self.options.textfile:
+            write_textfile(self.options.textfile, body)
+
+    def refresh_forever(self):
+        while True:
+            time.sleep(float(self.options.cache_ttl))
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.error("Exception refreshing metrics: %s", e)
+                flush_logbuffer(self.options)
+
+
+def make_exporter_server(cache, address):
+    '''
+    Returns a threaded HTTP server answering /metrics from cache.
+    '''
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = cache.body
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/openmetrics-text; '
+                             'version=1.0.0; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("%s - %s", self.address_string(), format % args)
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    return ThreadingHTTPServer(address, MetricsHandler)
+
+
+def run_exporter(options):
+    '''
+    --exporter: keeps the latest sample cached for --cache_ttl seconds
+    and serves it on --listen and/or writes it to --textfile for the
+    node_exporter textfile collector.
+    '''
+    import threading
+    cache = MetricsCache(options)
+    cache.refresh()
+    refresher = threading.Thread(target=cache.refresh_forever)
+    refresher.daemon = True
+    refresher.start()
+    if options.listen:
+        host, port = options.listen.rsplit(':', 1)
+        server = make_exporter_server(cache, (host, int(port)))
+        logging.info("Serving metrics on http://%s/metrics", options.listen)
+        server.serve_forever()
+    else:
+        refresher.join()
+
+
+def evaluate_host(options, memstats):
+    '''
+    Applies the thresholds in options to a host MemoryState and returns
+    (nagios_rc, msgstring, perfdata) for it.
+    '''
+    mw, mc, sw, sc = parse_thresholds(options)
+    tw = tc = None
+    if options.tte_warn_minutes:
+        tw = float(options.tte_warn_minutes) * 60
+    if options.tte_crit_minutes:
+        tc = float(options.tte_crit_minutes) * 60
+
+    effective = options.threshold_basis == 'effective' and memstats.accounting
+    checked = memstats
+    if effective:
+        checked = effective_state(memstats)
+
+    phase('evaluate')
+    if options.perfdata_only.lower() == 'no':
+        # pass in to check within ranges
+        nagios_rc = checked.within_critwarn_range(mw, mc, sw, sc, tw, tc,
+                                                  **psi_thresholds(options))
+    else:
+        nagios_rc = 0
+
+    phase('output')
+    perfdata = build_perfdata(memstats)
+    msgstring = build_message(memstats)
+    if effective:
+        perfdata.extend(accounting_perfdata(memstats))
+        total_mb, used_mb, swap_used_mb = checked.convert_bytes_to_mb()
+        msgstring += " --- EFFECTIVE:::: Used: %s MB of %s MB - %s%% used" % (
+            used_mb, total_mb, checked.mem_used_percentage_string)
+
+    if memstats.pressure and options.psi_metric in memstats.pressure:
+        msgstring += " --- PSI:::: %s %.2f%%" % (
+            options.psi_metric, memstats.pressure[options.psi_metric])
+    elif options.psi_warn_percentage or options.psi_crit_percentage:
+        msgstring += " --- PSI:::: %s unavailable" % options.psi_metric
+    if memstats.samples:
+        msgstring += " --- SAMPLES:::: %s of %d, %.2f%%-%.2f%% used" % (
+            memstats.samples['statistic'], memstats.samples['count'],
+            memstats.samples['min'], memstats.samples['max'])
+    return nagios_rc, msgstring, perfdata
+
+
+def add_top_processes(options, msgstring, perfdata):
+    # appends the --top memory consumers to perfdata, returns the new message
+    top = scan_top_processes(int(options.top), options.top_metric,
+                             float(options.top_budget_ms) / 1000)
+    msgstring += " --- TOP:::: " + ", ".join(
+        "%s(%d) %d MB" % (name, pid, value // 1024 // 1024)
+        for value, pid, name in top)
+    for rank, (value, pid, name) in enumerate(top):
+        perfdata.append(PerfChunk(
+            stringname='TOP%d_%s' % (rank + 1, options.top_metric.upper()),
+            value=value, unit='B'))
+    return msgstring
+
+
+def worst_returncode(returncodes):
+    # the most severe of returncodes in Nagios order, OK when there are none
+    return max(returncodes or [0], key=RC_SEVERITY.index)
+
+
+def format_result(nagios_rc, msgstring, perfdata, additional_lines=()):
+    '''
+    Returns (returncode, text) exactly as NagiosReturnCode.genreturncode
+    would report them, without raising. nagpyrc only takes OK, WARNING
+    and CRITICAL, so UNKNOWN is laid out as CRITICAL and renamed.
+    '''
+    nm = NagiosReturnCode(returncode=min(nagios_rc, 2), msgstring=msgstring)
+    for pc in perfdata:
+        nm.perfChunkList.append(pc)
+    nm.additionalLines.extend(additional_lines)
+    try:
+        nm.genreturncode()
+    except NagiosReturn as e:
+        if nagios_rc == 3:
+            return 3, 'UNKNOWN' + e.message[len('CRITICAL'):]
+        return e.code, e.message
+
+
+def load_profiles(path, options):
+    '''
+    Reads an INI style profiles file where every section is a named set
+    of thresholds, e.g.
+
+        [paging]
+        mem_warn_percentage = 95
+        mem_crit_percentage = 98
+
+    Settings left out of a section keep their command line values.
+    Returns a list of (name, options) in file order.
+    '''
+    import copy
+    try:
+        from configparser import RawConfigParser
+    except ImportError:
+        from ConfigParser import RawConfigParser
+    parser = RawConfigParser()
+    if not parser.read(path):
+        raise IOError("Unable to read profiles file '%s'" % path)
+    profiles = []
+    for name in parser.sections():
+        profile = copy.copy(options)
+        profile.service = name
+        for key, value in parser.items(name):
+            if key not in PROFILE_KEYS:
+                raise ValueError("Unknown setting '%s' in profile '%s' of '%s'" %
+                                 (key, name, path))
+            setattr(profile, key, value)
+        profiles.append((name, profile))
+    return profiles
+
+
+def write_spool(path, host, results):
+    '''
+    Appends one PROCESS_SERVICE_CHECK_RESULT external command per
+    (service, returncode, text) in results to path, either the Nagios
+    command pipe or a file picked up by something else. One write()
+    so concurrent writers don't interleave. path has to exist already,
+    and a pipe without a reader raises IOError instead of blocking.
+    '''
+    import errno
+    now = int(time.time())
+    lines = ''.join('[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n' %
+                    (now, host, service, code, text)
+                    for service, code, text in results)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_NONBLOCK)
+    except OSError as e:
+        if e.errno == errno.ENXIO:
+            raise IOError("Nothing is reading the command pipe '%s'" % path)
+        raise
+    try:
+        os.write(fd, lines.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+def main_profiles(options, memstats, profiles):
+    '''
+    --profiles: evaluates one collected MemoryState against every
+    profile and reports them as a single result. The worst profile
+    decides the return code, perfdata_only profiles never alert.
+    '''
+    results = []
+    for name, profile in profiles:
+        results.append((name, profile) + evaluate_host(profile, memstats))
+
+    if options.spool_file:
+        import socket
+        write_spool(options.spool_file, options.spool_host or socket.gethostname(),
+                    [(profile.service,) + format_result(rc, msg, perf)
+                     for name, profile, rc, msg, perf in results])
+
+    nagios_rc = worst_returncode([r[2] for r in results])
+    states = ", ".join("%s %s" % (name, RC_NAMES.get(rc, 'UNKNOWN'))
+                       for name, profile, rc, msg, perf in results)
+    additional_lines = []
+    # perfdata goes out once, long output only allows it after the first '|'
+    perfdata = build_perfdata(memstats)
+    if options.profile_output == 'separate':
+        msgstring = "PROFILES:::: " + states
+        for name, profile, rc, msg, perf in results:
+            additional_lines.append("%s: %s %s" % (name, RC_NAMES.get(rc, 'UNKNOWN'), msg))
+    else:
+        msgstring = build_message(memstats) + " --- PROFILES:::: " + states
+
+    if int(options.top) > 0 and nagios_rc in (1, 2):
+        phase('top')
+        msgstring = add_top_processes(options, msgstring, perfdata)
+
+    phase('output')
+    perfdata.extend(instrumentation_perfdata(options))
+    logging.info("Current RC = %s", nagios_rc)
+    code, text = format_result(nagios_rc, msgstring, perfdata, additional_lines)
+    raise NagiosReturn(text, code)
+
+
+def main(options, memstats=None):
+    ''' The main() method. Program starts here.
+    The check server passes in its cached memstats.
+    '''
+    if options.mode == 'cgroup':
+        return main_cgroup(options)
+    if options.mode == 'numa':
+        return main_numa(options)
+
+    profiles = []
+    if options.profiles:
+        profiles = load_profiles(options.profiles, options)
+    effective = [p for p in [options] + [p for name, p in profiles]
+                 if p.threshold_basis == 'effective']
+
+    if memstats is None:
+        phase('collect')
+        memstats = collect_memory(options, bool(effective))
+
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        phase('logging')
+        logging.info(memstats.dumpself())
+
+    if options.history_file:
+        phase('history')
+        record_history(options, memstats)
+
+    if psi_enabled(options) or [p for name, p in profiles if psi_enabled(p)]:
+        phase('pressure')
+        memstats.pressure = collect_pressure()
+
+    if effective:
+        phase('accounting')
+        collect_accounting(options, memstats)
+
+    if options.profiles:
+        return main_profiles(options, memstats, profiles)
+
+    nagios_rc, msgstring, perfdata = evaluate_host(options, memstats)
+
+    # only go looking for the culprits when someone is going to be paged
+    if int(options.top) > 0 and nagios_rc in (1, 2):
+        phase('top')
+        msgstring = add_top_processes(options, msgstring, perfdata)
+
+    phase('output')
+    perfdata.extend(instrumentation_perfdata(options))
+    logging.info("Current RC = %s", nagios_rc)
+    code, text = format_result(nagios_rc, msgstring, perfdata)
+    raise NagiosReturn(text, code)
+    '''
+    # add a perfdata chunk for total response time
+    pd = PerfChunk(stringname='response_time',value=response_time,unit='s')
+    # add it to the list of response perfdata
+    perfdata.append(pd)
+    # build your nagios message and tell it to be warn,crit,ok, etc.
+    # we'll start with a default of 1 which is warning
+    msgstring = "Elasticsearch Cluster Health API: " + str(status_code) + " " + str(status_string)
+    nm = NagiosReturnCode(returncode=1,msgstring=msgstring)
+    if status_code == 200:
+        nm.returnCode = 0
+    else:
+        nm.returnCode = 1
+    # append your perfdata chunks to the NagiosReturnCode object.
+    for perfchunk in perfdata:
+        nm.perfChunkList.append(perfchunk)
+    nm.genreturncode() # will raise a 'NagiosReturn' exception
+    '''
+
+
+def run_check(options, memstats=None):
+    '''
+    Runs main() and returns (returncode, text) the way __main__ would
+    print and exit with them. Errors come back as UNKNOWN.
+    '''
+    try:
+        main(options, memstats)
+    except NagiosReturn as e:
+        return e.code, e.message
+    except Exception as e:
+        logging.exception("Exception running check")
+        return 3, "UNKNOWN check_mem: %s" % e
+    return 3, "UNKNOWN check_mem: no result"
+
+
+def parse_request(args):
+    '''
+    Parses the arguments of a --server request with the same parser as
+    the command line. Only the REQUEST_OPTIONS may differ from their
+    defaults; anything touching files or the server's own settings
+    raises ValueError, as do arguments that aren't a list of strings.
+    '''
+    if not isinstance(args, list) or \
+            [a for a in args if not isinstance(a, (type(u''), str))]:
+        raise ValueError("a request must be a JSON list of strings")
+    parser = build_parser()
+    try:
+        options, rest = parser.parse_args([str(a) for a in args])
+    except SystemExit:
+        raise ValueError("invalid arguments: %s" % ' '.join(args))
+    if rest:
+        raise ValueError("unexpected arguments: %s" % ' '.join(rest))
+    defaults = parser.get_default_values()
+    for name in sorted(vars(options)):
+        if name not in REQUEST_OPTIONS and getattr(options, name) != getattr(defaults, name):
+            raise ValueError("--%s can't be requested from the server" % name)
+    return options
+
+
+class CollectionCache():
+    '''
+    Keeps the latest host MemoryState for --server for --cache_ttl
+    seconds. Requests arriving while a collection is running wait for
+    that collection instead of starting their own.
+    '''
+
+    def __init__(self, options, loop):
+        self.options = options
+        self.loop = loop
+        self.memstats = None
+        self.collected_at = 0
+        self.pending = None
+        self.collections = 0
+
+    def get(self):
+        # returns a future of the MemoryState, only call from the loop
+        if self.pending is not None:
+            return self.pending
+        if (self.memstats is not None and
+                time.time() - self.collected_at < float(self.options.cache_ttl)):
+            future = self.loop.create_future()
+            future.set_result(self.memstats)
+            return future
+        self.pending = self.loop.run_in_executor(None, collect_memory, self.options)
+        self.pending.add_done_callback(self.collected)
+        return self.pending
+
+    def collected(self, future):
+        self.pending = None
+        if not future.cancelled() and future.exception() is None:
+            self.memstats = future.result()
+            self.collected_at = time.time()
+            self.collections += 1
+
+
+def make_check_server(cache, address):
+    '''
+    Starts listening for check requests on address, a unix socket path
+    or HOST:PORT, on the cache's event loop and returns the server.
+
+    A request is one line holding a JSON list of check_mem arguments.
+    The reply is the return code on the first line and then the text
+    the check would print, after which the connection is closed.
+    '''
+    import asyncio
+    import copy
+    import json
+    loop = cache.loop
+
+    class CheckProtocol(asyncio.Protocol):
+
+        def connection_made(self, transport):
+            self.transport = transport
+            self.data = b''
+
+        def data_received(self, data):
+            self.data += data
+            if b'\n' not in self.data:
+                return
+            try:
+                options = parse_request(json.loads(
+                    self.data.split(b'\n', 1)[0].decode('utf-8')))
+            except ValueError as e:
+                self.respond(3, "UNKNOWN check_mem server: %s" % e)
+                return
+            if options.mode != 'host':
+                self.run(options)
+            else:
+                cache.get().add_done_callback(lambda f: self.collected(options, f))
+
+        def collected(self, options, future):
+            if future.exception() is not None:
+                self.respond(3, "UNKNOWN check_mem server: %s" % future.exception())
+                return
+            # main() fills in trend and pressure, keep the cached copy clean
+            self.run(options, copy.copy(future.result()))
+
+        def run(self, options, memstats=None):
+            result = loop.run_in_executor(None, run_check, options, memstats)
+            result.add_done_callback(lambda f: self.respond(*f.result()))
+
+        def respond(self, code, text):
+            self.transport.write(('%d\n%s' % (code, text)).encode('utf-8'))
+            self.transport.close()
+
+    if '/' in address:
+        if os.path.exists(address):
+            os.unlink(address)
+        listen = loop.create_unix_server(CheckProtocol, address)
+    else:
+        host, port = address.rsplit(':', 1)
+        listen = loop.create_server(CheckProtocol, host, int(port))
+    return loop.run_until_complete(listen)
+
+
+def run_server(options):
+    '''
+    --server: answers check requests from check_mem_client.py out of
+    one long running process, sharing collections between them.
+    '''
+    try:
+        import asyncio
+    except ImportError:
+        logging.error("--server needs python 3.5 or later for asyncio")
+        print("--server needs python 3.5 or later for asyncio")
+        return 3
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = make_check_server(CollectionCache(options, loop),
+                               options.server_address)
+    import signal
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    logging.info("Serving checks on %s", options.server_address)
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        loop.close()
+        if '/' in options.server_address and os.path.exists(options.server_address):
+            os.unlink(options.server_address)
+    return 0
+
+
+def build_parser():
+    '''Sets up the OptionParser for every mode of the script'''
+    from optparse import OptionParser
+    '''set up an additional option group just for debugging parameters'''
+    from optparse import OptionGroup
+    usage = (
+        "%prog [--debug] [--printtostdout] [--logfile] [--version] [--help] [--samplefileoption]")
+    # set up the parser object
+    parser = OptionParser(usage, version='%prog ' + sversion)
+    parser.add_option('-w', '--mem_warn_percentage',
+                      type='string',
+                      help=(
+                          "Warning threshold percentage for used memory. Default='90'"),
+                      default='90')
+    parser.add_option('-c', '--mem_crit_percentage',
+                      type='string',
+                      help=(
+                          "Critical threshold percentage for used memory. Default='95'"),
+                      default='95')
+    parser.add_option('--swap_warn_percentage',
+                      type='string',
+                      help=(
+                          "Warning threshold percentage for used swap. Default='75'"),
+                      default='75')
+    parser.add_option('--swap_crit_percentage',
+                      type='string',
+                      help=(
+                          "Critical threshold percentage for used swap. Default='90'"),
+                      default='90')
+    parser.add_option('--perfdata_only',
+                      type='string',
+                      help=("Options are 'no' or 'yes'. When yes then check will always "
+                            "return OK. Default='no'"),
+                      default='no')
+    parser.add_option('--collector',
+                      type='choice',
+                      choices=['auto', 'procfs', 'free', 'free-old', 'free-new',
+                               'cgroup'],
+                      help=("Where to read memory stats from. 'procfs' reads "
+                            "/proc/meminfo, 'free' runs the free command, "
+                            "'free-old'/'free-new' skip detecting its procps "
+                            "output format, 'cgroup' measures this process's "
+                            "own cgroup v2 group and 'auto' tries procfs first. "
+                            "Default='auto'"),
+                      default='auto')
+    parser.add_option('--used_formula',
+                      type='choice',
+                      choices=['auto', 'available', 'buffcache', 'buffers'],
+                      help=("How the procfs collector works out used memory. "
+                            "'available' is MemTotal - MemAvailable like "
+                            "procps-ng 4.x 'free', 'buffcache' is MemTotal - "
+                            "MemFree - buff/cache like procps-ng 3.3.10 to "
+                            "3.3.17, 'buffers' leaves SReclaimable out of the "
+                            "cache like procps 3.3.9 and 'auto' follows the "
+                            "installed 'free'. Default='auto'"),
+                      default='auto')
+    parser.add_option('--probe_cache', type='string', metavar='FILE',
+                      help=("Where 'auto' and 'free' remember what they "
+                            "found until the kernel or free binary changes, "
+                            "'' to probe every run. "
+                            "Default='" + defaultprobecachefile + "'"),
+                      default=defaultprobecachefile)
+    parser.add_option('--fixture', type='string', metavar='FILE',
+                      help=("Read memory stats from a saved /proc/meminfo or "
+                            "'free -b' output instead of the host. "
+                            "Default='' (off)"),
+                      default='')
+    parser.add_option('--mode',
+                      type='choice', choices=['host', 'cgroup', 'numa'],
+                      help=("What to check. 'host' checks the whole machine, "
+                            "'cgroup' checks every memory limited cgroup v2 "
+                            "against its own limit, 'numa' checks every NUMA "
+                            "node on its own. Default='host'"),
+                      default='host')
+    parser.add_option('--cgroup_root', type='string', metavar='DIR',
+                      help=("Root of the cgroup v2 hierarchy for --mode cgroup. "
+                            "Default='" + defaultcgrouproot + "'"),
+                      default=defaultcgrouproot)
+    parser.add_option('--node_root', type='string', metavar='DIR',
+                      help=("sysfs directory holding the node* directories "
+                            "for --mode numa. Default='" + defaultnoderoot + "'"),
+                      default=defaultnoderoot)
+    parser.add_option('--cgroup_top', type='string',
+                      help=("Number of worst cgroups named in the output for "
+                            "--mode cgroup. Default='5'"),
+                      default='5')
+    parser.add_option('--threshold_basis',
+                      type='choice', choices=['used', 'effective'],
+                      help=("What -w/-c are checked against. 'used' is used "
+                            "memory as 'free' reports it, 'effective' leaves "
+                            "the hugetlb pool out of total and used and adds "
+                            "slab, hugepage, zswap and zram perfdata. "
+                            "Default='used'"),
+                      default='used')
+    parser.add_option('--samples', type='string',
+                      help=("Readings to take in one run. Thresholds are "
+                            "checked against --statistic of them. Default='1'"),
+                      default='1')
+    parser.add_option('--interval', type='string', metavar='MS',
+                      help=("Milliseconds between --samples readings. "
+                            "Default='10'"),
+                      default='10')
+    parser.add_option('--statistic',
+                      type='choice', choices=['p50', 'p95', 'max', 'mean'],
+                      help=("What --samples readings are checked against. "
+                            "Default='p95'"),
+                      default='p95')
+    parser.add_option('--top', type='string',
+                      help=("On WARNING or CRITICAL, list the N processes using "
+                            "the most memory. Default='0' (off)"),
+                      default='0')
+    parser.add_option('--top_metric',
+                      type='choice', choices=['rss', 'pss'],
+                      help=("Memory figure used to rank processes for --top. "
+                            "Default='rss'"),
+                      default='rss')
+    parser.add_option('--top_budget_ms', type='string',
+                      help=("Stop scanning processes for --top after this many "
+                            "milliseconds. Default='200'"),
+                      default='200')
+    parser_psi = OptionGroup(parser, 'Memory Pressure Options')
+    parser_psi.add_option('--psi', action='store_true', default=False,
+                          help=('Report memory pressure stall information from '
+                                '/proc/pressure/memory (or memory.pressure per '
+                                'cgroup) as perfdata'))
+    parser_psi.add_option('--psi_warn_percentage', type='string',
+                          help=("Warning threshold for the --psi_metric stall "
+                                "percentage. Implies --psi. Default='' (off)"),
+                          default='')
+    parser_psi.add_option('--psi_crit_percentage', type='string',
+                          help=("Critical threshold for the --psi_metric stall "
+                                "percentage. Implies --psi. Default='' (off)"),
+                          default='')
+    parser_psi.add_option('--psi_metric',
+                          type='choice', choices=list(PRESSURE_METRICS),
+                          help=("Pressure average the PSI thresholds apply to. "
+                                "Default='some_avg60'"),
+                          default='some_avg60')
+    parser.add_option_group(parser_psi)
+    parser.add_option('--profiles', type='string', metavar='FILE',
+                      help=("INI file of named threshold profiles to evaluate "
+                            "against a single collection. Default='' (off)"),
+                      default='')
+    parser.add_option('--profile_output',
+                      type='choice', choices=['combined', 'separate'],
+                      help=("'combined' reports the worst profile with one set "
+                            "of perfdata, 'separate' adds a full result line per "
+                            "profile. Default='combined'"),
+                      default='combined')
+    parser.add_option('--spool_file', type='string', metavar='FILE',
+                      help=("Also append each profile's result as a passive "
+                            "PROCESS_SERVICE_CHECK_RESULT command to FILE, "
+                            "using the section name or its 'service' setting "
+                            "as the service. Default='' (off)"),
+                      default='')
+    parser.add_option('--spool_host', type='string',
+                      help=("Host name for --spool_file results. Default is "
+                            "this machine's hostname"),
+                      default='')
+    parser.add_option('--replay', type='string', metavar='FILE',
+                      help=("Instead of checking, replay the samples in FILE "
+                            "(a --history_file or timestamp,total,used,"
+                            "swap_total,swap_used CSV) against the thresholds "
+                            "and report alerts and flaps. Thresholds accept "
+                            "start:stop:step ranges. Default='' (off)"),
+                      default='')
+    parser_daemon = OptionGroup(parser, 'Daemon Options')
+    parser_daemon.add_option('--daemon', action='store_true', default=False,
+                             help=('Run as a resident sampler that keeps the '
+                                   'snapshot file up to date'))
+    parser_daemon.add_option('--daemon_interval', type='string',
+                             help=("Seconds between samples in daemon mode. "
+                                   "Default='5'"),
+                             default='5')
+    parser_daemon.add_option('--snapshot_file', type='string', metavar='FILE',
+                             help=("Snapshot file written by the daemon and read "
+                                   "by checks. Set to '' to always collect live. "
+                                   "Default='" + defaultsnapshotfile + "'"),
+                             default=defaultsnapshotfile)
+    parser_daemon.add_option('--snapshot_max_age', type='string',
+                             help=("Seconds after which a snapshot is considered "
+                                   "stale and memory is collected live. "
+                                   "Default='15'"),
+                             default='15')
+    parser.add_option_group(parser_daemon)
+    parser_exporter = OptionGroup(parser, 'Exporter Options')
+    parser_exporter.add_option('--exporter', action='store_true', default=False,
+                               help=('Run as a Prometheus/OpenMetrics exporter '
+                                     'instead of checking'))
+    parser_exporter.add_option('--listen', type='string', metavar='HOST:PORT',
+                               help=("Address to serve /metrics on, '' to only "
+                                     "write --textfile. Default='127.0.0.1:9117'"),
+                               default='127.0.0.1:9117')
+    parser_exporter.add_option('--textfile', type='string', metavar='FILE',
+                               help=("Also write the metrics to FILE for the "
+                                     "node_exporter textfile collector. "
+                                     "Default='' (off)"),
+                               default='')
+    parser_exporter.add_option('--cache_ttl', type='string',
+                               help=("Seconds a collected sample is served before "
+                                     "collecting again. Default='15'"),
+                               default='15')
+    parser.add_option_group(parser_exporter)
+
+    parser_server = OptionGroup(parser, 'Check Server Options')
+    parser_server.add_option('--server', action='store_true', default=False,
+                             help=('Answer check requests from check_mem_client.py '
+                                   'instead of checking. Host mode requests share '
+                                   'one collection per --cache_ttl'))
+    parser_server.add_option('--server_address', type='string',
+                             metavar='PATH|HOST:PORT',
+                             help=("Unix socket or TCP address to listen on. "
+                                   "Default='" + defaultserveraddress + "'"),
+                             default=defaultserveraddress)
+    parser.add_option_group(parser_server)
+
+    parser_fleet = OptionGroup(parser, 'Fleet Options')
+    parser_fleet.add_option('--fleet', type='string', metavar='DIR|-',
+                            help=("Check a directory of saved meminfo or "
+                                  "'free -b' outputs, one file per host, or "
+                                  "JSON lines from stdin with '-', instead of "
+                                  "this host. Default='' (off)"),
+                            default='')
+    parser_fleet.add_option('--fleet_workers', type='string',
+                            help=("Worker processes for --fleet, 0 for one per "
+                                  "CPU. Default='0'"),
+                            default='0')
+    parser_fleet.add_option('--fleet_chunk', type='string',
+                            help=("Snapshots handed to a worker at a time. "
+                                  "Default='64'"),
+                            default='64')
+    parser.add_option_group(parser_fleet)
+    parser_history = OptionGroup(parser, 'History Options')
+    parser_history.add_option('--history_file', type='string', metavar='FILE',
+                              help=("Ring buffer file each sample is appended to, "
+                                    "used to estimate time to exhaustion. "
+                                    "Default='' (off)"),
+                              default='')
+    parser_history.add_option('--history_size', type='string',
+                              help=("Number of samples kept in the history file. "
+                                    "Default='43200' (30 days of 1 minute checks)"),
+                              default='43200')
+    parser_history.add_option('--trend_window', type='string',
+                              help=("Seconds of history the usage trend is fitted "
+                                    "over. Default='3600'"),
+                              default='3600')
+    parser_history.add_option('--tte_warn_minutes', type='string',
+                              help=("Warn when memory or swap will run out within "
+                                    "this many minutes at the current trend. "
+                                    "Default='' (off)"),
+                              default='')
+    parser_history.add_option('--tte_crit_minutes', type='string',
+                              help=("Critical when memory or swap will run out "
+                                    "within this many minutes at the current "
+                                    "trend. Default='' (off)"),
+                              default='')
+    parser.add_option_group(parser_history)
+    parser_debug = OptionGroup(parser, 'Debug Options')
+    parser_debug.add_option('-d', '--debug', type='string',
+                            help=('Available levels are CRITICAL (3), ERROR (2), '
+                                  'WARNING (1), INFO (0), DEBUG (-1)'),
+                            default='CRITICAL')
+    parser_debug.add_option('-p', '--printtostdout', action='store_true',
+                            default=False, help='Print all log messages to stdout')
+    parser_debug.add_option('-l', '--logfile', type='string', metavar='FILE',
+                            help=('Desired filename of log file output. Default '
+                                  'is "' + defaultlogfilename + '"'), default=defaultlogfilename)
+    parser_debug.add_option('--logmode',
+                            type='choice', choices=['buffer', 'file'],
+                            help=("'buffer' keeps log records in memory and only "
+                                  "appends them to the log file when the result "
+                                  "isn't OK or --debug is below CRITICAL. 'file' "
+                                  "rewrites the log file on every run. "
+                                  "Default='buffer'"),
+                            default='buffer')
+    parser_debug.add_option('--log_buffer_size', type='string',
+                            help=("Log records kept in memory with --logmode "
+                                  "buffer. Default='1000'"),
+                            default='1000')
+    parser_debug.add_option('--log_max_bytes', type='string',
+                            help=("Size at which the buffered log file is rotated "
+                                  "to FILE.1. Default='1048576'"),
+                            default='1048576')
+    # officially adds the debuggin option group
+    parser.add_option_group(parser_debug)
+
+    parser_instrument = OptionGroup(parser, 'Instrumentation Options')
+    parser_instrument.add_option('--instrument', action='store_true', default=False,
+                                 help=('Add check_duration, per phase timings, '
+                                       'peak RSS and CPU time as perfdata'))
+    parser_instrument.add_option('--latency_budget_ms', type='string',
+                                 help=("Runs slower than this are logged and "
+                                       "trigger --cprofile_dump. Default='0' "
+                                       "(no budget)"),
+                                 default='0')
+    parser_instrument.add_option('--cprofile_dump', type='string', metavar='FILE',
+                                 help=("Profile the run with cProfile and write "
+                                       "the stats to FILE when it goes over "
+                                       "--latency_budget_ms. Default='' (off)"),
+                                 default='')
+    parser.add_option_group(parser_instrument)
+    return parser
+
+
+if __name__ == '__main__':
+    '''This main section is mostly for parsing arguments to the
+    script and setting up debugging'''
+    parser = build_parser()
+    options, args = parser.parse_args()  # here's where the options get parsed
+
+    try:  # now try and get the debugging options
+        loglevel = getattr(logging, options.debug)
+    except AttributeError:  # set the log level
+        loglevel = {3: logging.CRITICAL,
+                    2: logging.ERROR,
+                    1: logging.WARNING,
+                    0: logging.INFO,
+                    -1: logging.DEBUG,
+                    }[int(options.debug)]
+
+    if options.logmode == 'file':
+        try:
+            open(options.logfile, 'w')  # try and open the default log file
+        except:
+            # print "Unable to open log file '%s' for writing." % options.logfile
+            logging.debug(
+                "Unable to open log file '%s' for writing.", options.logfile)
+
+    setuplogging(loglevel, options.printtostdout, options.logfile,
+                 options.logmode, int(options.log_buffer_size))
+    # now launch the main method. Have to do a try catch for Nagios
+    #  to properly see the application's exit return code.
+
+    if options.replay:
+        sys.exit(run_replay(options))
+
+    if options.fleet:
+        sys.exit(run_fleet(options))
+
+    if options.server:
+        try:
+            sys.exit(run_server(options))
+        except KeyboardInterrupt:
+            sys.exit(0)
+
+    if options.exporter:
+        try:
+            run_exporter(options)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    if options.daemon:
+        try:
+            run_daemon(options)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    profiler = start_instrumentation(options)
+    returncode = 3
     try:
-        main(options)
-    except NagiosReturn, e:
-        print e.message
-        sys.exit(e.code)
+        # anything other than a NagiosReturn still has to come out UNKNOWN
+        returncode, text = run_check(options)
+        print(text)
+    finally:
+        if profiler is not None:
+            stop_instrumentation(options, profiler)
+        # the buffered log only reaches the disk when someone will want it
+        if returncode != 0 or loglevel < logging.CRITICAL:
+            flush_logbuffer(options)
+    sys.exit(returncode)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+'''
+Thin Nagios/NRPE entry point for a running 'check_mem.py --server'.
+
+Takes exactly the same arguments as check_mem.py, hands them to the
+server and prints its answer, so pollers pay for this small script
+instead of a full check_mem.py start up. When no server is listening
+it runs check_mem.py itself.
+
+The server address is taken from the CHECK_MEM_SERVER environment
+variable, a unix socket path or HOST:PORT. Default '/run/check_mem.sock'
+'''
+import os
+import sys
+import json
+import socket
+
+defaultserveraddress = '/run/check_mem.sock'
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def connect(address, timeout):
+    if '/' in address:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        target = address
+    else:
+        host, port = address.rsplit(':', 1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        target = (host, int(port))
+    sock.settimeout(timeout)
+    try:
+        sock.connect(target)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def request(sock, args):
+    '''
+    Sends one check request over a connected socket and returns
+    (returncode, text) from the server's reply.
+    '''
+    sock.sendall((json.dumps(list(args)) + '\n').encode('utf-8'))
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    code, text = b''.join(chunks).decode('utf-8').split('\n', 1)
+    return int(code), text
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    address = os.environ.get('CHECK_MEM_SERVER', defaultserveraddress)
+    try:
+        sock = connect(address, 30)
+    except (IOError, OSError):
+        # no server running, do the check the slow way
+        script = os.path.join(here, 'check_mem.py')
+        os.execv(sys.executable, [sys.executable, script] + args)
+    try:
+        returncode, text = request(sock, args)
+    except (IOError, OSError, ValueError) as e:
+        returncode, text = 3, "UNKNOWN check_mem client: %s" % e
+    finally:
+        sock.close()
+    print(text)
+    sys.exit(returncode)
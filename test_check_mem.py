@@ -0,0 +1,1373 @@
+#!/usr/bin/env python2
+'''
+Unit tests for check_mem.py, kept out of the plugin itself so a check
+run doesn't have to import unittest.
+
+Usage:
+python -m unittest test_check_mem
+'''
+
+import os
+import sys
+import time
+import array
+import random
+import logging
+import itertools
+import threading
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+import check_mem
+from check_mem import MemoryState
+from check_mem import MEMINFO_FIELDS
+from check_mem import parse_meminfo
+from check_mem import process_meminfo
+from check_mem import process_results
+from check_mem import MeminfoSampler
+from check_mem import process_text
+from check_mem import collect_zram
+from check_mem import effective_state
+from check_mem import evaluate_host
+from check_mem import select_collector
+from check_mem import probe_key
+from check_mem import read_probe_cache
+from check_mem import CgroupCollector
+from check_mem import sample_statistic
+from check_mem import SnapshotWriter
+from check_mem import read_snapshot
+from check_mem import SNAPSHOT_FIELDS
+from check_mem import SNAPSHOT_BODY
+from check_mem import SNAPSHOT_SEQ
+from check_mem import SNAPSHOT_SEQ_OFFSET
+from check_mem import collect_cgroups
+from check_mem import collect_numa
+from check_mem import scan_top_processes
+from check_mem import HistoryStore
+from check_mem import fit_exhaustion
+from check_mem import parse_pressure
+from check_mem import RingBufferHandler
+from check_mem import load_replay_samples
+from check_mem import parse_range
+from check_mem import replay_evaluate
+from check_mem import render_openmetrics
+from check_mem import MetricsCache
+from check_mem import make_exporter_server
+from check_mem import build_parser
+from check_mem import run_check
+from check_mem import PhaseTimer
+from check_mem import start_instrumentation
+from check_mem import stop_instrumentation
+from check_mem import CollectionCache
+from check_mem import make_check_server
+from check_mem import run_fleet
+from check_mem import Histogram
+from bench_check_mem import compare_results
+import check_mem_client
+from bench_check_mem import FREE_FIXTURES
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# sample /proc/pressure/memory
+PRESSURE = ('some avg10=12.50 avg60=4.00 avg300=1.25 total=123456\n'
+            'full avg10=2.00 avg60=0.50 avg300=0.10 total=2345\n')
+
+
+def fixture(name):
+    with open(os.path.join(here, 'fixtures', name)) as f:
+        return f.read()
+
+
+# Budgets in microseconds for a check's start up, a little over what
+# they measure today. 'import check_mem' from cached bytecode (cumulative
+# as reported by python -X importtime) catches heavy modules pulled back
+# onto the startup path. Running check_mem.py as a script recompiles it
+# every time, so compiling it has a budget of its own.
+STARTUP_BUDGET_US = 25000
+COMPILE_BUDGET_US = 40000
+
+# modules that only specific collectors or modes need
+LAZY_MODULES = ('unittest', 'subprocess', 'optparse', 'distutils',
+                'datetime', 'tempfile', 'mmap', 'logging.handlers', 'numpy')
+
+
+class Test_crit_warn(unittest.TestCase):
+
+    def test_all_good(self):
+        # MemoryState(total,used,free,shared,buffcache,swap_total,swap_used,swap_free,available)
+        m = MemoryState(8000, 100, 100, 1, 1, 2000, 0, 2000, None)
+        mem_warn_value = 90.00
+        mem_crit_value = 95.00
+        swap_warn_value = 80.00
+        swap_crit_value = 90.00
+        return_value = m.within_critwarn_range(
+            mem_warn_value, mem_crit_value, swap_warn_value, swap_crit_value)
+        expected_value = 0
+        self.assertEqual(return_value, expected_value)
+
+    def test_mem_warn(self):
+        # MemoryState(total,used,free,shared,buffcache,swap_total,swap_used,swap_free,available)
+        m = MemoryState(8000, 7300, 100, 1, 1, 2000, 0, 2000, None)
+        mem_warn_value = 90.00
+        mem_crit_value = 95.00
+        swap_warn_value = 80.00
+        swap_crit_value = 90.00
+        return_value = m.within_critwarn_range(
+            mem_warn_value, mem_crit_value, swap_warn_value, swap_crit_value)
+        expected_value = 1
+        self.assertEqual(return_value, expected_value)
+
+    def test_mem_crit(self):
+        # MemoryState(total,used,free,shared,buffcache,swap_total,swap_used,swap_free,available)
+        m = MemoryState(8000, 7900, 100, 1, 1, 2000, 0, 2000, None)
+        mem_warn_value = 90.00
+        mem_crit_value = 95.00
+        swap_warn_value = 80.00
+        swap_crit_value = 90.00
+        return_value = m.within_critwarn_range(
+            mem_warn_value, mem_crit_value, swap_warn_value, swap_crit_value)
+        expected_value = 2
+        self.assertEqual(return_value, expected_value)
+
+    def test_swap_warn(self):
+        # MemoryState(total,used,free,shared,buffcache,swap_total,swap_used,swap_free,available)
+        m = MemoryState(8000, 2000, 6000, 1, 1, 2000, 1800, 200, None)
+        mem_warn_value = 90.00
+        mem_crit_value = 95.00
+        swap_warn_value = 80.00
+        swap_crit_value = 90.00
+        return_value = m.within_critwarn_range(
+            mem_warn_value, mem_crit_value, swap_warn_value, swap_crit_value)
+        expected_value = 1
+        self.assertEqual(return_value, expected_value)
+
+    def test_swap_crit(self):
+        # MemoryState(total,used,free,shared,buffcache,swap_total,swap_used,swap_free,available)
+        m = MemoryState(8000, 2000, 6000, 1, 1, 2000, 1900, 200, None)
+        mem_warn_value = 90.00
+        mem_crit_value = 95.00
+        swap_warn_value = 80.00
+        swap_crit_value = 90.00
+        return_value = m.within_critwarn_range(
+            mem_warn_value, mem_crit_value, swap_warn_value, swap_crit_value)
+        expected_value = 2
+        self.assertEqual(return_value, expected_value)
+
+    def test_swap_trumps_mem(self):
+        # MemoryState(total,used,free,shared,buffcache,swap_total,swap_used,swap_free,available)
+        m = MemoryState(8000, 7300, 6000, 1, 1, 2000, 1900, 200, None)
+        mem_warn_value = 90.00
+        mem_crit_value = 95.00
+        swap_warn_value = 80.00
+        swap_crit_value = 90.00
+        return_value = m.within_critwarn_range(
+            mem_warn_value, mem_crit_value, swap_warn_value, swap_crit_value)
+        expected_value = 2
+        self.assertEqual(return_value, expected_value)
+
+    def test_mem_trumps_swap(self):
+        # MemoryState(total,used,free,shared,buffcache,swap_total,swap_used,swap_free,available)
+        m = MemoryState(8000, 7900, 6000, 1, 1, 2000, 100, 200, None)
+        mem_warn_value = 90.00
+        mem_crit_value = 95.00
+        swap_warn_value = 80.00
+        swap_crit_value = 90.00
+        return_value = m.within_critwarn_range(
+            mem_warn_value, mem_crit_value, swap_warn_value, swap_crit_value)
+        expected_value = 2
+        self.assertEqual(return_value, expected_value)
+
+    def test_bad_warn_value_returns_unknown(self):
+        # MemoryState(total,used,free,shared,buffcache,swap_total,swap_used,swap_free,available)
+        m = MemoryState(8000, 7900, 6000, 1, 1, 2000, 100, 200, None)
+        mem_warn_value = '90%'
+        mem_crit_value = 95.00
+        swap_warn_value = 80.00
+        swap_crit_value = 90.00
+        return_value = m.within_critwarn_range(
+            mem_warn_value, mem_crit_value, swap_warn_value, swap_crit_value)
+        expected_value = 3
+        self.assertEqual(return_value, expected_value)
+
+
+class Test_memorystate(unittest.TestCase):
+
+    def test_derived_fields_are_lazy(self):
+        m = MemoryState(8000, 7300, 100, 1, 1, 2000, 10, 1990, None)
+        self.assertFalse(hasattr(m, '__dict__'))
+        self.assertEqual((m._available, m._mem_pct, m._mem_pct_str, m._mb),
+                         (None, None, None, None))
+        self.assertEqual(m.within_critwarn_range(90, 95, 75, 90), 1)
+        self.assertEqual(m._mem_pct_str, None)
+        self.assertEqual(m.available, 700)
+        self.assertEqual(m.determine_used_percentages(), (91.25, '91.25', 0.5, '0.50'))
+        self.assertEqual(m.convert_bytes_to_mb(), (0, 0, 0))
+
+    def test_from_packed(self):
+        records = [(1000.0 + i, 8000, 7000 + i, 100, 1, 1, 2000, i, 2000 - i, 1000 - i)
+                   for i in range(50)]
+        buffer = b''.join(SNAPSHOT_BODY.pack(*r) for r in records)
+        states = MemoryState.from_packed(buffer)
+        self.assertEqual(len(states), 50)
+        self.assertEqual(states[7].sampled_at, 1007.0)
+        self.assertEqual([getattr(states[7], f) for f in SNAPSHOT_FIELDS],
+                         list(records[7][1:]))
+        self.assertEqual(len(MemoryState.from_packed(buffer, SNAPSHOT_BODY.size * 48)), 2)
+        self.assertEqual(MemoryState.from_packed(buffer, count=3)[2].used, 7002)
+
+
+class Test_meminfo(unittest.TestCase):
+
+    def test_parse_meminfo(self):
+        meminfo = parse_meminfo(fixture('meminfo.txt'))
+        self.assertEqual(meminfo['MemTotal'], 6305947648)
+        self.assertEqual(meminfo['SwapFree'], 1717305344)
+        self.assertEqual(sorted(meminfo), sorted(MEMINFO_FIELDS))
+
+    def test_parse_meminfo_missing_field(self):
+        meminfo = parse_meminfo('MemTotal:   1024 kB\nMemFree:   512 kB\n')
+        self.assertEqual(meminfo, {'MemTotal': 1048576, 'MemFree': 524288})
+
+    def test_meminfo_matches_free(self):
+        m_proc = process_meminfo(parse_meminfo(fixture('meminfo.txt')))
+        m_free = process_results(
+            '4.0.2', fixture('free_b_procps-ng-4.0.2.txt').splitlines(True))
+        for attr in ('total', 'used', 'free', 'shared', 'buffcache',
+                     'swap_total', 'swap_used', 'swap_free', 'available'):
+            self.assertEqual(getattr(m_proc, attr), getattr(m_free, attr))
+
+    def test_meminfo_matches_free_3_3_10(self):
+        # the meminfo behind the procps-ng 3.3.10 fixture, whose used
+        # leaves out buff/cache rather than MemAvailable
+        meminfo = parse_meminfo(
+            'MemTotal:        1884388 kB\nMemFree:          999424 kB\n'
+            'MemAvailable:    1461248 kB\nBuffers:           20000 kB\n'
+            'Cached:           682988 kB\nSwapTotal:       1679356 kB\n'
+            'SwapFree:        1678136 kB\nShmem:             90112 kB\n'
+            'SReclaimable:      30000 kB\n')
+        m_free = process_results(
+            '3.3.10', fixture('free_b_procps-ng-3.3.10.txt').splitlines(True))
+        m_proc = process_meminfo(meminfo, 'buffcache')
+        for attr in ('total', 'used', 'free', 'shared', 'buffcache',
+                     'swap_total', 'swap_used', 'swap_free', 'available'):
+            self.assertEqual(getattr(m_proc, attr), getattr(m_free, attr))
+        self.assertNotEqual(process_meminfo(meminfo).used, m_free.used)
+
+    def test_meminfo_matches_free_3_3_9(self):
+        # '-/+ buffers/cache' of procps 3.3.9 leaves SReclaimable out
+        meminfo = parse_meminfo(
+            'MemTotal:        8176000 kB\nMemFree:         5118336 kB\n'
+            'MemAvailable:    6000000 kB\nBuffers:          196608 kB\n'
+            'Cached:          1239040 kB\nSwapTotal:       1047548 kB\n'
+            'SwapFree:        1047548 kB\nShmem:             11264 kB\n'
+            'SReclaimable:      50000 kB\n')
+        m_free = process_results(
+            '3.3.9', fixture('free_b_procps-3.3.9.txt').splitlines(True))
+        m_proc = process_meminfo(meminfo, 'buffers')
+        for attr in ('total', 'used', 'free', 'shared', 'buffcache',
+                     'swap_total', 'swap_used', 'swap_free'):
+            self.assertEqual(getattr(m_proc, attr), getattr(m_free, attr))
+
+    def test_free_fixtures(self):
+        # used as reported by each version, old procps includes buffers/cache
+        expected = {'3.3.9': 1660944384, '3.3.10': 155623424, '4.0.2': 482590720}
+        for name, version in FREE_FIXTURES:
+            m = process_results(version, fixture(name).splitlines(True))
+            self.assertEqual(m.used, expected[version])
+
+
+class Test_accounting(unittest.TestCase):
+
+    def setUp(self):
+        # 2 GB of the 6 GB reserved as hugepages
+        self.meminfo = fixture('meminfo.txt').replace(
+            'MemAvailable:    5686872 kB', 'MemAvailable:    1686872 kB').replace(
+            'HugePages_Total:       0', 'HugePages_Total:    1024').replace(
+            'HugePages_Free:        0', 'HugePages_Free:      24').replace(
+            'Hugetlb:               0 kB', 'Hugetlb:         2097152 kB')
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_effective_leaves_out_hugetlb(self):
+        memstats = process_text(self.meminfo)
+        self.assertEqual(memstats.accounting['hugetlb'], 2097152 * 1024)
+        self.assertEqual(memstats.accounting['hugepages_free'], 24 * 2048 * 1024)
+        checked = effective_state(memstats)
+        self.assertEqual(memstats.mem_used_percentage_string, '72.61')
+        self.assertEqual(checked.mem_used_percentage_string, '58.46')
+        self.assertEqual(checked.swap_used, memstats.swap_used)
+
+    def test_old_kernel_fallback(self):
+        memstats = process_text(
+            'MemTotal: 1000 kB\nMemFree: 100 kB\nBuffers: 100 kB\nCached: 200 kB\n'
+            'SwapTotal: 0 kB\nSwapFree: 0 kB\nHugePages_Total: 100\n'
+            'Hugepagesize: 2 kB\n')
+        self.assertEqual(memstats.accounting['effective_total'], 800 * 1024)
+        self.assertEqual(memstats.accounting['effective_available'], 400 * 1024)
+
+    def test_threshold_basis(self):
+        path = os.path.join(self.dir, 'meminfo')
+        write_files(self.dir, {'meminfo': self.meminfo})
+        code, message = run_main(['--fixture', path, '-w', '70', '-c', '90'])
+        self.assertEqual(code, 1)
+        options, rest = build_parser().parse_args(['--fixture', path, '-w', '70',
+                                                   '--threshold_basis', 'effective'])
+        memstats = process_text(self.meminfo)
+        rc, msgstring, perfdata = evaluate_host(options, memstats)
+        self.assertEqual(rc, 0)
+        self.assertTrue('EFFECTIVE:::: Used: 2318 MB of 3965 MB - 58.46% used' in msgstring)
+        names = [pc.stringname for pc in perfdata]
+        self.assertTrue('EFFECTIVE_USED_PCT' in names and 'HUGETLB' in names)
+
+    def test_effective_burst(self):
+        # the statistic of the effective readings is checked, not the last one
+        readings = [self.meminfo, self.meminfo.replace(
+            'MemAvailable:    1686872 kB', 'MemAvailable:    3686872 kB')]
+
+        class Sampler(MeminfoSampler):
+            def __init__(self, path):
+                self.readings = list(readings)
+
+            def read(self, fields=MEMINFO_FIELDS):
+                return parse_meminfo(self.readings.pop(0), fields)
+
+            def close(self):
+                pass
+
+        sampler = check_mem.MeminfoSampler
+        check_mem.MeminfoSampler = Sampler
+        try:
+            code, message = run_main(['--snapshot_file', '', '--collector', 'procfs',
+                                      '--samples', '2', '--interval', '1',
+                                      '--statistic', 'max', '--threshold_basis', 'effective',
+                                      '-w', '50', '-c', '90'])
+        finally:
+            check_mem.MeminfoSampler = sampler
+        self.assertEqual(code, 1)
+        self.assertTrue('EFFECTIVE:::: Used: 2318 MB of 3965 MB - 58.46% used' in message)
+
+    def test_zram(self):
+        write_files(os.path.join(self.dir, 'zram0'),
+                    {'mm_stat': '  4096000  1024000  1200000        0  1200000   10    0    0    0\n'})
+        write_files(os.path.join(self.dir, 'zram1'), {'mm_stat': '100 50 60 0 60 0 0\n'})
+        write_files(os.path.join(self.dir, 'loop0'), {'mm_stat': '1 1 1\n'})
+        self.assertEqual(collect_zram(self.dir),
+                         {'zram_orig': 4096100, 'zram_compr': 1024050, 'zram_used': 1200060})
+        self.assertEqual(collect_zram(os.path.join(self.dir, 'missing'))['zram_used'], 0)
+
+
+class Test_samples(unittest.TestCase):
+
+    def test_statistic(self):
+        values = array.array('d', range(100, 0, -1))
+        self.assertEqual(sample_statistic(values, 'p50'), 50)
+        self.assertEqual(sample_statistic(values, 'p95'), 95)
+        self.assertEqual(sample_statistic(values, 'max'), 100)
+        self.assertEqual(sample_statistic(values, 'mean'), 50.5)
+        self.assertEqual(sample_statistic([7.0], 'p50'), 7.0)
+
+    def test_sampler_rereads(self):
+        path = tempfile.mktemp()
+        try:
+            with open(path, 'w') as f:
+                f.write(fixture('meminfo.txt'))
+            sampler = MeminfoSampler(path)
+            first = sampler.read()
+            with open(path, 'r+') as f:
+                f.write('MemTotal:        1 kB\n')
+            second = sampler.read()
+            sampler.close()
+        finally:
+            os.unlink(path)
+        self.assertEqual(first, parse_meminfo(fixture('meminfo.txt')))
+        self.assertEqual(second['MemTotal'], 1024)
+
+    def test_burst(self):
+        code, message = run_main(['--snapshot_file', '', '--samples', '20',
+                                  '--interval', '1', '--statistic', 'max'])
+        self.assertTrue('SAMPLES:::: max of 20' in message)
+        self.assertTrue("'MEM_USED_PCT_P95'=" in message)
+
+
+class Test_collectors(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.dir, 'check_mem.probe')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def select(self, *args):
+        options, rest = build_parser().parse_args(['--probe_cache', self.cache] +
+                                                  list(args))
+        return select_collector(options)
+
+    def test_process_text_detects_format(self):
+        meminfo = fixture('meminfo.txt')
+        self.assertEqual(process_text(meminfo).dumpself(),
+                         process_meminfo(parse_meminfo(meminfo)).dumpself())
+        for name, version in FREE_FIXTURES:
+            lines = fixture(name).splitlines(True)
+            self.assertEqual(process_text(fixture(name)).dumpself(),
+                             process_results(version, lines).dumpself())
+
+    def test_probe_is_cached(self):
+        with open(self.cache, 'w') as f:
+            f.write('free_version=3.3.10\nkey=%s\n' % probe_key())
+        self.assertEqual(self.select('--collector', 'free').free_version, '3.3.10')
+        with open(self.cache, 'w') as f:
+            f.write('free_version=3.3.10\nkey=stale\n')
+        collector = self.select('--collector', 'auto')
+        self.assertEqual(collector.name, 'procfs')
+        cached = read_probe_cache(self.cache)
+        self.assertEqual((cached['auto'], cached['key']), ('procfs', probe_key()))
+        self.assertFalse('free_version' in cached)
+        # the procps version behind the used formula is cached too
+        with open(self.cache, 'w') as f:
+            f.write('auto=procfs\nkey=%s\nprocps=3.3.10\n' % probe_key())
+        self.assertEqual(self.select('--collector', 'procfs').formula, 'buffcache')
+        self.assertEqual(self.select('--used_formula', 'available').formula, 'available')
+        with open(self.cache, 'w') as f:
+            f.write('auto=procfs\nkey=%s\nprocps=4.0.2\n' % probe_key())
+        self.assertEqual(self.select().formula, 'available')
+        with open(self.cache, 'w') as f:
+            f.write('auto=procfs\nkey=%s\nprocps=3.3.9\n' % probe_key())
+        self.assertEqual(self.select().formula, 'buffers')
+
+    def test_procps_version_is_probed_once(self):
+        calls = []
+        saved = check_mem.procpsversion, check_mem.detect_free_version
+        check_mem.procpsversion = None
+        check_mem.detect_free_version = lambda: calls.append(1) or '3.3.10'
+        try:
+            for i in range(3):
+                self.assertEqual(self.select('--probe_cache', '').formula, 'buffcache')
+        finally:
+            check_mem.procpsversion, check_mem.detect_free_version = saved
+        self.assertEqual(len(calls), 1)
+
+    def test_fixture(self):
+        code, message = run_main(['--fixture', os.path.join(here, 'fixtures',
+                                                            FREE_FIXTURES[0][0]),
+                                  '-w', '15', '-c', '30'])
+        self.assertEqual(code, 1)
+        self.assertTrue('Used: 1584 MB - 19.84% used' in message)
+
+    def test_cgroup(self):
+        write_files(os.path.join(self.dir, 'pods/db'),
+                    {'memory.current': '900\n', 'memory.max': '1000\n',
+                     'memory.stat': 'file 100\ninactive_file 100\n'})
+        write_files(self.dir, {'cgroup': '0::/pods/db\n'})
+        memstats = CgroupCollector(self.dir, os.path.join(self.dir, 'cgroup')).collect()
+        self.assertEqual(memstats.mem_used_percentage, 80.0)
+        # the root cgroup has no memory.max
+        write_files(self.dir, {'cgroup': '0::/\n'})
+        collector = CgroupCollector(self.dir, os.path.join(self.dir, 'cgroup'))
+        self.assertRaises(ValueError, collector.collect)
+
+    def test_foreign_probe_cache_is_ignored(self):
+        with open(self.cache, 'w') as f:
+            f.write('auto=free\nfree_version=3.3.9\nkey=%s\n' % probe_key())
+        self.assertNotEqual(read_probe_cache(self.cache), {})
+        geteuid = os.geteuid
+        os.geteuid = lambda: geteuid() + 1
+        try:
+            self.assertEqual(read_probe_cache(self.cache), {})
+        finally:
+            os.geteuid = geteuid
+
+
+class Test_snapshot(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.m = MemoryState(8000, 7300, 100, 1, 1, 2000, 10, 1990, None)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_roundtrip(self):
+        writer = SnapshotWriter(self.path)
+        writer.write(self.m, time.time())
+        writer.close()
+        m = read_snapshot(self.path, 30)
+        for attr in SNAPSHOT_FIELDS:
+            self.assertEqual(getattr(m, attr), getattr(self.m, attr))
+        self.assertEqual(m.mem_used_percentage, self.m.mem_used_percentage)
+
+    def test_stale_snapshot_is_ignored(self):
+        writer = SnapshotWriter(self.path)
+        writer.write(self.m, time.time() - 60)
+        writer.close()
+        self.assertEqual(read_snapshot(self.path, 30), None)
+
+    def test_snapshot_being_written_is_ignored(self):
+        writer = SnapshotWriter(self.path)
+        writer.write(self.m, time.time())
+        SNAPSHOT_SEQ.pack_into(writer.mm, SNAPSHOT_SEQ_OFFSET, 3)
+        writer.close()
+        self.assertEqual(read_snapshot(self.path, 30, retries=2), None)
+
+    def test_missing_or_foreign_file_is_ignored(self):
+        self.assertEqual(read_snapshot(self.path, 30), None)
+        self.assertEqual(read_snapshot(self.path + '.missing', 30), None)
+
+    def test_snapshot_others_could_write_is_ignored(self):
+        writer = SnapshotWriter(self.path)
+        writer.write(self.m, time.time())
+        writer.close()
+        os.chmod(self.path, 0o666)
+        self.assertEqual(read_snapshot(self.path, 30), None)
+        os.chmod(self.path, 0o644)
+        if os.geteuid() == 0:
+            os.chown(self.path, 12345, -1)
+            self.assertEqual(read_snapshot(self.path, 30), None)
+
+    def test_writer_replaces_what_was_there(self):
+        target = self.path + '.target'
+        with open(target, 'w') as f:
+            f.write('keep')
+        os.remove(self.path)
+        os.symlink(target, self.path)
+        try:
+            writer = SnapshotWriter(self.path)
+            writer.write(self.m, time.time())
+            writer.close()
+            self.assertFalse(os.path.islink(self.path))
+            with open(target) as f:
+                self.assertEqual(f.read(), 'keep')
+            self.assertEqual(read_snapshot(self.path, 30).used, self.m.used)
+        finally:
+            os.remove(target)
+
+    def test_explicit_collector_reads_live(self):
+        writer = SnapshotWriter(self.path)
+        writer.write(self.m, time.time())
+        writer.close()
+        args = ['--snapshot_file', self.path, '-w', '90', '-c', '99.9',
+                '--swap_warn_percentage', '100', '--swap_crit_percentage', '100']
+        self.assertTrue("'TOTAL'=8000B" in run_main(args)[1])
+        self.assertFalse("'TOTAL'=8000B" in run_main(args + ['--collector', 'procfs'])[1])
+
+
+def write_files(path, files):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name, content in files.items():
+        with open(os.path.join(path, name), 'w') as f:
+            f.write(content)
+
+
+def run_main(args):
+    # an empty --probe_cache keeps the tests off the real cache file
+    options, rest = build_parser().parse_args(['--probe_cache', ''] + args)
+    return run_check(options)
+
+
+class Test_cgroup(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make_cgroup(self, name, current, limit, inactive_file=0, swap=None):
+        files = {'memory.current': '%d\n' % current,
+                 'memory.max': '%s\n' % limit,
+                 'memory.stat': ('anon %d\nfile %d\nkernel 0\n'
+                                 'shmem 0\ninactive_file %d\n' %
+                                 (current, inactive_file, inactive_file))}
+        if swap is not None:
+            files['memory.swap.current'] = '%d\n' % swap[0]
+            files['memory.swap.max'] = '%s\n' % swap[1]
+        write_files(os.path.join(self.root, name), files)
+
+    def test_walk_skips_unlimited(self):
+        self.make_cgroup('system.slice', 5000, 'max')
+        self.make_cgroup('system.slice/db.service', 900, 1000, 100)
+        self.make_cgroup('kubepods/pod1', 100, 1000, swap=(50, 100))
+        states = dict(collect_cgroups(self.root))
+        self.assertEqual(sorted(states), ['kubepods/pod1', 'system.slice/db.service'])
+        self.assertEqual(states['system.slice/db.service'].used, 800)
+        self.assertEqual(states['system.slice/db.service'].total, 1000)
+        self.assertEqual(states['kubepods/pod1'].swap_used_percentage, 50.0)
+
+    def test_worst_cgroup_decides(self):
+        for i in range(50):
+            self.make_cgroup('pods/ok%d' % i, 100, 1000)
+        self.make_cgroup('pods/warn', 920, 1000)
+        self.make_cgroup('pods/crit', 990, 1000)
+        code, message = run_main(['--mode', 'cgroup', '--cgroup_root', self.root,
+                                  '--cgroup_top', '2'])
+        self.assertEqual(code, 2)
+        self.assertTrue('52 checked - 1 critical - 1 warning' in message)
+        self.assertTrue('Worst: pods/crit 99.00% used, pods/warn 92.00% used' in message)
+        self.assertTrue("'pods/ok7_MEM_USED_PCT'=10.00%" in message)
+
+    def test_cgroup_pressure(self):
+        self.make_cgroup('pods/stalled', 100, 1000)
+        write_files(os.path.join(self.root, 'pods/stalled'),
+                    {'memory.pressure': PRESSURE})
+        code, message = run_main(['--mode', 'cgroup', '--cgroup_root', self.root,
+                                  '--psi_crit_percentage', '3'])
+        self.assertEqual(code, 2)
+        self.assertTrue("'pods/stalled_PSI_SOME_AVG60'=4.00%" in message)
+
+    def test_perfdata_only(self):
+        self.make_cgroup('pods/crit', 990, 1000)
+        code, message = run_main(['--mode', 'cgroup', '--cgroup_root', self.root,
+                                  '--perfdata_only', 'yes'])
+        self.assertEqual(code, 0)
+
+    def test_missing_root_is_unknown(self):
+        code, message = run_main(['--mode', 'cgroup', '--cgroup_root',
+                                  os.path.join(self.root, 'missing')])
+        self.assertEqual(code, 3)
+        self.assertTrue(message.startswith('UNKNOWN check_mem: '))
+
+
+class Test_numa(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        write_files(self.root, {'online': '0-1\n'})
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make_node(self, node, total, free, filepages, sreclaimable=0):
+        lines = [('MemTotal', total), ('MemFree', free), ('MemUsed', total - free),
+                 ('FilePages', filepages), ('Shmem', 0),
+                 ('SReclaimable', sreclaimable)]
+        write_files(os.path.join(self.root, 'node%d' % node), {'meminfo': ''.join(
+            'Node %d %-15s %8d kB\n' % (node, key + ':', value) for key, value in lines)})
+
+    def test_collect(self):
+        self.make_node(10, 1000, 100, 200, 50)
+        self.make_node(2, 1000, 900, 0)
+        states = collect_numa(self.root)
+        self.assertEqual([name for name, memstats in states], ['node2', 'node10'])
+        self.assertEqual(states[1][1].used, 650 * 1024)
+        self.assertEqual(states[1][1].total, 1000 * 1024)
+        self.assertEqual(states[1][1].available, 350 * 1024)
+
+    def test_worst_node_decides(self):
+        self.make_node(0, 4000000, 3000000, 500000)
+        self.make_node(1, 4000000, 100000, 80000)
+        code, message = run_main(['--mode', 'numa', '--node_root', self.root,
+                                  '-w', '80', '-c', '95'])
+        self.assertEqual(code, 2)
+        self.assertTrue('node0: 488 of 3906 MB - 12.50% used' in message)
+        self.assertTrue("'NODE1_MEM_USED_PCT'=95.50%" in message)
+
+    def test_missing_nodes_are_unknown(self):
+        for root in (os.path.join(self.root, 'missing'), self.root):
+            code, message = run_main(['--mode', 'numa', '--node_root', root])
+            self.assertEqual(code, 3)
+            self.assertTrue(message.startswith('UNKNOWN check_mem: '))
+
+
+class Test_top(unittest.TestCase):
+
+    def setUp(self):
+        self.proc = tempfile.mkdtemp()
+        self.pagesize = os.sysconf('SC_PAGE_SIZE')
+        for pid in range(1, 21):
+            write_files(os.path.join(self.proc, str(pid)),
+                        {'statm': '%d %d 10 1 0 5 0\n' % (pid * 10, pid),
+                         'comm': 'proc%d\n' % pid,
+                         'smaps_rollup': 'Rss: %d kB\nPss: %d kB\n' % (pid, 40 - pid)})
+        write_files(os.path.join(self.proc, 'self'), {'statm': '1 999999\n'})
+        os.makedirs(os.path.join(self.proc, '21'))
+
+    def tearDown(self):
+        shutil.rmtree(self.proc)
+
+    def test_top_rss(self):
+        top = scan_top_processes(3, proc=self.proc)
+        self.assertEqual(top, [(20 * self.pagesize, 20, 'proc20'),
+                               (19 * self.pagesize, 19, 'proc19'),
+                               (18 * self.pagesize, 18, 'proc18')])
+
+    def test_top_pss(self):
+        top = scan_top_processes(2, metric='pss', proc=self.proc)
+        self.assertEqual(top, [(39 * 1024, 1, 'proc1'), (38 * 1024, 2, 'proc2')])
+
+    def test_only_scanned_when_alerting(self):
+        code, message = run_main(['-w', '99.9', '-c', '100', '--top', '3',
+                                  '--snapshot_file', ''])
+        self.assertEqual(code, 0)
+        self.assertFalse('TOP::::' in message)
+        code, message = run_main(['-w', '0', '-c', '100', '--top', '3',
+                                  '--snapshot_file', ''])
+        self.assertEqual(code, 1)
+        self.assertTrue('TOP::::' in message)
+        self.assertTrue("'TOP1_RSS'=" in message)
+
+
+class Test_history(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_ring_keeps_newest(self):
+        store = HistoryStore(self.path, 5)
+        for t in range(12):
+            store.append(1000 + t, MemoryState(8000, t, 0, 0, 0, 0, 0, 0, None))
+        self.assertEqual(store.count(), 12)
+        self.assertEqual([r[1] for r in store.since(0)], [7, 8, 9, 10, 11])
+        self.assertEqual([r[1] for r in store.since(1010)], [10, 11])
+        store.close()
+        self.assertEqual(os.path.getsize(self.path), 24 + 5 * 40)
+
+    def test_duplicate_sample_is_skipped(self):
+        store = HistoryStore(self.path, 5)
+        m = MemoryState(8000, 100, 0, 0, 0, 0, 0, 0, None)
+        store.append(1000, m)
+        store.append(1000, m)
+        self.assertEqual(store.count(), 1)
+        store.close()
+
+    def test_capacity_change_starts_over(self):
+        store = HistoryStore(self.path, 5)
+        store.append(1000, MemoryState(8000, 100, 0, 0, 0, 0, 0, 0, None))
+        store.close()
+        store = HistoryStore(self.path, 10)
+        self.assertEqual(store.count(), 0)
+        store.close()
+
+    def test_start_over_waits_for_the_lock(self):
+        import fcntl
+        stores = []
+        with open(self.path, 'r+') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            thread = threading.Thread(target=lambda: stores.append(HistoryStore(self.path, 5)))
+            thread.start()
+            time.sleep(0.1)
+            self.assertEqual(os.path.getsize(self.path), 0)
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            thread.join()
+        self.assertEqual(stores[0].count(), 0)
+        stores[0].close()
+        self.assertEqual(os.path.getsize(self.path), 24 + 5 * 40)
+
+    def test_fit_exhaustion(self):
+        # growing 10 bytes a second, 9600 bytes left after the last sample
+        samples = [(t, 5000 + 10 * t, 20000) for t in range(0, 600, 60)]
+        self.assertAlmostEqual(fit_exhaustion(samples), 960.0)
+        self.assertEqual(fit_exhaustion([(0, 10, 100), (60, 5, 100)]), None)
+        self.assertEqual(fit_exhaustion([(0, 10, 100)]), None)
+
+    def test_tte_thresholds(self):
+        m = MemoryState(8000, 100, 100, 1, 1, 2000, 0, 2000, None)
+        m.mem_exhaustion_seconds = 500
+        self.assertEqual(m.within_critwarn_range(90, 95, 80, 90, 600, 300), 1)
+        self.assertEqual(m.within_critwarn_range(90, 95, 80, 90, 600, 900), 2)
+        self.assertEqual(m.within_critwarn_range(90, 95, 80, 90), 0)
+        m.mem_exhaustion_seconds = None
+        self.assertEqual(m.within_critwarn_range(90, 95, 80, 90, 600, 900), 0)
+
+    def test_main_records_history(self):
+        args = ['--history_file', self.path, '--snapshot_file', '']
+        run_main(args)
+        code, message = run_main(args)
+        store = HistoryStore(self.path, 43200)
+        self.assertEqual(store.count(), 2)
+        store.close()
+
+    def test_snapshot_sample_is_recorded_once(self):
+        snapshot = self.path + '.snapshot'
+        writer = SnapshotWriter(snapshot)
+        try:
+            writer.write(MemoryState(8000, 100, 0, 0, 0, 0, 0, 0, None), time.time())
+            args = ['--history_file', self.path, '--snapshot_file', snapshot]
+            self.assertEqual(run_main(args)[0], 0)
+            self.assertEqual(run_main(args)[0], 0)
+        finally:
+            writer.close()
+            os.remove(snapshot)
+        store = HistoryStore(self.path, 43200)
+        self.assertEqual(store.count(), 1)
+        self.assertEqual(store.record(0)[1], 100)
+        store.close()
+
+
+class Test_pressure(unittest.TestCase):
+
+    def test_parse_pressure(self):
+        pressure = parse_pressure(PRESSURE)
+        self.assertEqual(pressure['some_avg10'], 12.5)
+        self.assertEqual(pressure['full_avg300'], 0.1)
+        self.assertEqual(pressure['some_total'], 123456)
+        self.assertEqual(len(pressure), 8)
+
+    def test_psi_thresholds(self):
+        m = MemoryState(8000, 100, 100, 1, 1, 2000, 0, 2000, None)
+        m.pressure = parse_pressure(PRESSURE)
+        self.assertEqual(m.within_critwarn_range(90, 95, 80, 90), 0)
+        self.assertEqual(m.within_critwarn_range(90, 95, 80, 90, psi_warn=3,
+                                                 psi_crit=5), 1)
+        self.assertEqual(m.within_critwarn_range(90, 95, 80, 90, psi_warn=3,
+                                                 psi_crit=5, psi_metric='some_avg10'), 2)
+        self.assertEqual(m.within_critwarn_range(90, 95, 80, 90, psi_warn=3,
+                                                 psi_crit=5, psi_metric='full_avg10'), 0)
+
+    def test_psi_combines_with_memory(self):
+        m = MemoryState(8000, 7900, 100, 1, 1, 2000, 0, 2000, None)
+        m.pressure = parse_pressure(PRESSURE)
+        self.assertEqual(m.within_critwarn_range(90, 95, 80, 90, psi_warn=3), 2)
+
+    def test_missing_pressure_is_unknown(self):
+        m = MemoryState(8000, 100, 100, 1, 1, 2000, 0, 2000, None)
+        self.assertEqual(m.within_critwarn_range(90, 95, 80, 90), 0)
+        self.assertEqual(m.within_critwarn_range(90, 95, 80, 90, psi_warn=0), 3)
+        # a real alert still outranks it
+        self.assertEqual(m.within_critwarn_range(0, 95, 80, 90, psi_warn=0), 1)
+
+    def test_check_without_pressure(self):
+        collect_pressure = check_mem.collect_pressure
+        check_mem.collect_pressure = lambda: None
+        try:
+            code, message = run_main(['--snapshot_file', '', '-w', '99.9', '-c', '100',
+                                      '--swap_warn_percentage', '100',
+                                      '--swap_crit_percentage', '100',
+                                      '--psi_warn_percentage', '10'])
+        finally:
+            check_mem.collect_pressure = collect_pressure
+        self.assertEqual(code, 3)
+        self.assertTrue(message.startswith('UNKNOWN MEMORY::::'))
+        self.assertTrue('PSI:::: some_avg60 unavailable' in message)
+
+
+class Test_logbuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.logfile = os.path.join(self.dir, 'check_mem.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_record(self, msg, *args):
+        return logging.LogRecord('root', logging.INFO, __file__, 1, msg, args, None)
+
+    def test_ring_keeps_newest_records(self):
+        handler = RingBufferHandler(3)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        for i in range(5):
+            handler.handle(self.make_record('record %d', i))
+        self.assertFalse(os.path.exists(self.logfile))
+        handler.write(self.logfile, 1048576)
+        handler.write(self.logfile, 1048576)
+        with open(self.logfile) as f:
+            self.assertEqual(f.read(), 'record 2\nrecord 3\nrecord 4\n')
+
+    def test_rotation(self):
+        handler = RingBufferHandler(100)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        for i in range(50):
+            handler.handle(self.make_record('x' * 20))
+        handler.write(self.logfile, 200)
+        self.assertTrue(os.path.exists(self.logfile + '.1'))
+        self.assertTrue(os.path.getsize(self.logfile) <= 200)
+
+    def run_check(self, *args):
+        p = subprocess.Popen((sys.executable, os.path.join(here, 'check_mem.py'),
+                              '--logfile', self.logfile, '--snapshot_file', '',
+                              '--probe_cache', '') + args,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        p.communicate()
+        return p.returncode
+
+    def test_no_log_file_when_ok(self):
+        self.assertEqual(self.run_check('-w', '99.9', '-c', '100'), 0)
+        self.assertFalse(os.path.exists(self.logfile))
+
+    def test_log_file_when_debugging(self):
+        self.assertEqual(self.run_check('-w', '99.9', '-c', '100', '-d', 'INFO'), 0)
+        with open(self.logfile) as f:
+            self.assertTrue('Current RC = 0' in f.read())
+
+
+class Test_replay(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(42)
+        self.samples = []
+        used = 5000
+        for i in range(500):
+            used = min(max(used + rng.randint(-400, 400), 0), 10000)
+            swap_total = 0 if i % 11 == 0 else 2000
+            self.samples.append((1000 + i * 60, 10000, used, swap_total,
+                                 rng.randint(0, swap_total)))
+        self.grid = list(itertools.product([80.0, 90.0], [95.0, 85.0],
+                                           [50.0, 75.0], [90.0]))
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def scalar(self):
+        # the reference: one MemoryState per sample through within_critwarn_range
+        results = []
+        for mw, mc, sw, sc in self.grid:
+            states = [MemoryState(total, used, 0, 0, 0, swap_total, swap_used,
+                                  swap_total - swap_used, None).within_critwarn_range(
+                                      mw, mc, sw, sc)
+                      for t, total, used, swap_total, swap_used in self.samples]
+            flaps = sum(1 for a, b in zip(states, states[1:]) if a != b)
+            results.append(((mw, mc, sw, sc), states.count(1), states.count(2), flaps))
+        return results
+
+    def columns(self, numpy=None):
+        columns = [[s[2] for s in self.samples], [s[1] for s in self.samples],
+                   [s[4] for s in self.samples], [s[3] for s in self.samples]]
+        if numpy is not None:
+            return [numpy.array(c, dtype=numpy.float64) for c in columns]
+        return [array.array('d', c) for c in columns]
+
+    def test_python_matches_scalar(self):
+        self.assertEqual(replay_evaluate(*(self.columns() + [self.grid])),
+                         self.scalar())
+
+    def test_numpy_matches_scalar(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        self.assertEqual(replay_evaluate(*(self.columns(numpy) + [self.grid])),
+                         self.scalar())
+
+    def test_load_csv_and_history(self):
+        csv = os.path.join(self.dir, 'samples.csv')
+        with open(csv, 'w') as f:
+            f.write('timestamp,total,used,swap_total,swap_used\n')
+            for sample in self.samples:
+                f.write('%d,%d,%d,%d,%d\n' % sample)
+        history = os.path.join(self.dir, 'history')
+        # smaller than the sample count so the ring has wrapped
+        store = HistoryStore(history, 300)
+        for t, total, used, swap_total, swap_used in self.samples:
+            store.append(t, MemoryState(total, used, 0, 0, 0, swap_total,
+                                        swap_used, swap_total - swap_used, None))
+        store.close()
+        expected = self.columns()
+        for column, loaded in zip(expected, load_replay_samples(csv)):
+            self.assertEqual(list(column), list(loaded))
+        for column, loaded in zip(expected, load_replay_samples(history)):
+            self.assertEqual(list(column)[-300:], list(loaded))
+
+    def test_load_truncated_history(self):
+        history = os.path.join(self.dir, 'history')
+        store = HistoryStore(history, 300)
+        store.close()
+        with open(history, 'rb+') as f:
+            f.truncate(1000)
+        os.chmod(history, 0o444)
+        with open(history, 'rb') as f:
+            data = f.read()
+        self.assertRaises(ValueError, load_replay_samples, history)
+        with open(history, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range('80:95:5'), [80.0, 85.0, 90.0, 95.0])
+        self.assertEqual(parse_range('90'), [90.0])
+        self.assertEqual(parse_range('0.1:0.3:0.1'), [0.1, 0.2, 0.3])
+
+
+class Test_exporter(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_render_openmetrics(self):
+        m = MemoryState(8000, 7300, 100, 1, 1, 2000, 10, 1990, None)
+        m.pressure = parse_pressure(PRESSURE)
+        body = render_openmetrics(m)
+        self.assertTrue('# TYPE check_mem_used_bytes gauge\ncheck_mem_used_bytes 7300.0\n' in body)
+        self.assertTrue('check_mem_mem_used_percent 91.25\n' in body)
+        self.assertTrue('# TYPE check_mem_psi_some_seconds counter\n'
+                        'check_mem_psi_some_seconds_total 0.123456\n' in body)
+        self.assertTrue(body.endswith('# EOF\n'))
+
+    def test_scrapes_are_served_from_cache(self):
+        try:
+            from urllib.request import urlopen
+        except ImportError:
+            from urllib2 import urlopen
+        textfile = os.path.join(self.dir, 'check_mem.prom')
+        options, args = build_parser().parse_args(['--snapshot_file', '', '--probe_cache', '',
+                                                   '--textfile', textfile])
+        cache = MetricsCache(options)
+        cache.refresh()
+        server = make_exporter_server(cache, ('127.0.0.1', 0))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d/metrics' % server.server_address[1]
+            bodies = []
+            scrapers = [threading.Thread(target=lambda: bodies.append(urlopen(url).read()))
+                        for i in range(10)]
+            for scraper in scrapers:
+                scraper.start()
+            for scraper in scrapers:
+                scraper.join()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(bodies, [cache.body] * 10)
+        self.assertEqual(cache.collections, 1)
+        with open(textfile, 'rb') as f:
+            self.assertEqual(f.read(), cache.body)
+
+
+class Test_profiles(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.profiles = os.path.join(self.dir, 'profiles.ini')
+        self.spool = os.path.join(self.dir, 'spool')
+        with open(self.profiles, 'w') as f:
+            f.write("[paging]\n"
+                    "mem_warn_percentage = 100\nmem_crit_percentage = 100\n"
+                    "swap_warn_percentage = 100\nswap_crit_percentage = 100\n"
+                    "[ticketing]\nservice = Memory Ticket\n"
+                    "mem_warn_percentage = 0\nmem_crit_percentage = 0.00001\n"
+                    "[graphs]\nperfdata_only = yes\nmem_warn_percentage = 0\n")
+        self.base = ['--snapshot_file', '', '--profiles', self.profiles,
+                     '--swap_warn_percentage', '100', '--swap_crit_percentage', '100']
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_combined(self):
+        open(self.spool, 'w').close()
+        code, message = run_main(self.base + ['--spool_file', self.spool,
+                                              '--spool_host', 'web01'])
+        self.assertEqual(code, 2)
+        self.assertTrue('PROFILES:::: paging OK, ticketing CRITICAL, graphs OK' in message)
+        self.assertEqual(message.count("'MEM_USED_PCT'="), 1)
+        with open(self.spool) as f:
+            lines = f.read().splitlines()
+        self.assertEqual([l.split(';')[1:4] for l in lines],
+                         [['web01', 'paging', '0'], ['web01', 'Memory Ticket', '2'],
+                          ['web01', 'graphs', '0']])
+        self.assertTrue(lines[1].split(';', 4)[4].startswith('CRITICAL'))
+
+    def test_separate(self):
+        code, message = run_main(self.base + ['--profile_output', 'separate'])
+        self.assertEqual(code, 2)
+        lines = [l.strip() for l in message.splitlines()]
+        self.assertTrue(lines[0].startswith('CRITICAL PROFILES:::: paging OK'))
+        self.assertTrue(lines[2].startswith('ticketing: CRITICAL MEMORY::::'))
+        self.assertEqual(message.count("'MEM_USED_PCT'="), 1)
+
+    def test_unknown_setting(self):
+        with open(self.profiles, 'a') as f:
+            f.write("[typo]\nmem_warn = 10\n")
+        code, message = run_main(self.base)
+        self.assertEqual(code, 3)
+        self.assertTrue("Unknown setting 'mem_warn' in profile 'typo'" in message)
+
+    def test_missing_profiles_file(self):
+        code, message = run_main(['--snapshot_file', '', '--profiles', self.spool])
+        self.assertEqual(code, 3)
+
+    def test_unknown_profile_ranks_below_critical(self):
+        with open(self.profiles, 'a') as f:
+            f.write("[broken]\nmem_warn_percentage = lots\n")
+        code, message = run_main(self.base)
+        self.assertEqual(code, 2)
+        self.assertTrue('ticketing CRITICAL, graphs OK, broken UNKNOWN' in message)
+        with open(self.profiles, 'w') as f:
+            f.write("[broken]\nmem_warn_percentage = lots\n[graphs]\nperfdata_only = yes\n")
+        code, message = run_main(self.base)
+        self.assertEqual(code, 3)
+        self.assertTrue(message.startswith('UNKNOWN MEMORY::::'))
+
+    def test_spool_is_never_created_or_waited_on(self):
+        self.assertEqual(run_main(self.base + ['--spool_file', self.spool])[0], 3)
+        self.assertFalse(os.path.exists(self.spool))
+        os.mkfifo(self.spool)
+        code, message = run_main(self.base + ['--spool_file', self.spool])
+        self.assertEqual(code, 3)
+        self.assertTrue('Nothing is reading the command pipe' in message)
+
+
+class Test_server(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            import asyncio
+        except ImportError:
+            self.skipTest('asyncio needs python 3')
+        self.dir = tempfile.mkdtemp()
+        self.address = os.path.join(self.dir, 'check_mem.sock')
+        options, args = build_parser().parse_args(['--snapshot_file', '', '--probe_cache', '',
+                                                   '--cache_ttl', '60'])
+        self.loop = asyncio.new_event_loop()
+        self.cache = CollectionCache(options, self.loop)
+        self.server = make_check_server(self.cache, self.address)
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.server.close()
+        self.loop.close()
+        shutil.rmtree(self.dir)
+
+    def check(self, args):
+        sock = check_mem_client.connect(self.address, 10)
+        try:
+            return check_mem_client.request(sock, args)
+        finally:
+            sock.close()
+
+    def test_requests_share_a_collection(self):
+        args = ['-w', '0', '-c', '100', '--swap_warn_percentage', '100', '--swap_crit_percentage', '100']
+        results = []
+        clients = [threading.Thread(target=lambda: results.append(self.check(args)))
+                   for i in range(20)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        self.assertEqual(len(results), 20)
+        self.assertEqual(len(set(results)), 1)
+        code, text = results[0]
+        self.assertEqual(code, 1)
+        self.assertTrue(text.startswith('WARNING MEMORY::::'))
+        self.assertEqual(self.cache.collections, 1)
+        self.assertEqual(self.check(args + ['--perfdata_only', 'yes'])[0], 0)
+
+    def test_bad_request(self):
+        code, text = self.check(['--mode', 'nonsense'])
+        self.assertEqual(code, 3)
+        self.assertTrue(text.startswith('UNKNOWN check_mem server: invalid arguments'))
+        self.assertEqual(self.check(['--daemon'])[0], 3)
+        self.assertEqual(self.check(['extra'])[0], 3)
+
+    def test_request_cant_set_paths(self):
+        history = os.path.join(self.dir, 'history')
+        for args in (['--history_file', history], ['--probe_cache', history],
+                     ['--spool_file', history, '--profiles', history],
+                     ['--node_root', self.dir], ['-l', history]):
+            code, text = self.check(args)
+            self.assertEqual(code, 3)
+            self.assertTrue("can't be requested from the server" in text)
+        self.assertFalse(os.path.exists(history))
+
+    def test_request_must_be_a_list(self):
+        for raw in (b'5\n', b'{"-w": "10"}\n', b'[["-w"]]\n'):
+            sock = check_mem_client.connect(self.address, 10)
+            try:
+                sock.sendall(raw)
+                reply = sock.recv(65536).decode('utf-8')
+            finally:
+                sock.close()
+            self.assertTrue(reply.startswith('3\nUNKNOWN check_mem server: '))
+
+    def test_client_runs_check_without_server(self):
+        env = dict(os.environ, CHECK_MEM_SERVER=self.address + '.missing')
+        p = subprocess.Popen([sys.executable, os.path.join(here, 'check_mem_client.py'),
+                              '--snapshot_file', '', '--probe_cache', '',
+                              '--perfdata_only', 'yes',
+                              '-l', os.path.join(self.dir, 'check_mem.log')],
+                             stdout=subprocess.PIPE, env=env, universal_newlines=True)
+        out, err = p.communicate()
+        self.assertEqual(p.returncode, 0)
+        self.assertTrue(out.startswith('OK MEMORY::::'))
+
+
+class Test_instrument(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        check_mem.phasetimer = None
+        shutil.rmtree(self.dir)
+
+    def test_phase_timer(self):
+        timer = PhaseTimer()
+        ticks = iter([1.0, 2.0, 5.0, 6.0])
+        timer.clock = lambda: next(ticks)
+        timer.start('collect')
+        timer.start('output')
+        timer.start('collect')
+        self.assertEqual(timer.phases(), [('collect', 2.0), ('output', 3.0)])
+
+    def test_perfdata(self):
+        args = ['--snapshot_file', '', '--instrument', '--latency_budget_ms', '500']
+        options, rest = build_parser().parse_args(args)
+        self.assertEqual(start_instrumentation(options), None)
+        code, message = run_main(args)
+        for name in ('check_phase_read_procfile', 'check_phase_memorystate',
+                     'check_phase_evaluate', 'check_phase_output'):
+            self.assertTrue("'%s'=" % name in message, name)
+        self.assertTrue(";0.5;;; 'check_phase_collect'" in message)
+        self.assertTrue("'check_maxrss'=" in message)
+
+    def test_cprofile_dump(self):
+        dump = os.path.join(self.dir, 'check_mem.prof')
+        args = ['--snapshot_file', '', '--cprofile_dump', dump,
+                '--latency_budget_ms', '60000']
+        options, rest = build_parser().parse_args(args)
+        stop_instrumentation(options, start_instrumentation(options))
+        self.assertFalse(os.path.exists(dump))
+        options.latency_budget_ms = '0'
+        profiler = start_instrumentation(options)
+        code, message = run_main(args)
+        stop_instrumentation(options, profiler)
+        self.assertTrue(os.path.getsize(dump) > 0)
+        self.assertFalse('check_duration' in message)
+
+
+class Test_fleet(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.hosts = os.path.join(self.dir, 'hosts')
+        os.mkdir(self.hosts)
+        names = [name for name, version in FREE_FIXTURES] + ['meminfo.txt']
+        for i in range(40):
+            shutil.copy(os.path.join(here, 'fixtures', names[i % 4]),
+                        os.path.join(self.hosts, 'host%02d.txt' % i))
+        write_files(self.hosts, {'broken.txt': 'not a snapshot\n'})
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def fleet(self, args, stream=None):
+        options, rest = build_parser().parse_args(args)
+        with tempfile.TemporaryFile('w+') as out:
+            code = run_fleet(options, out, stream)
+            out.seek(0)
+            return code, out.read().splitlines()
+
+    def test_directory(self):
+        code, lines = self.fleet(['--fleet', self.hosts, '--fleet_workers', '2',
+                                  '--fleet_chunk', '3', '-w', '15', '-c', '30'])
+        self.assertEqual(code, 3)
+        rows = dict((line.split('\t')[0], line.split('\t')[1:]) for line in lines[1:-2])
+        self.assertEqual(len(rows), 41)
+        self.assertEqual(rows['host00'][:2], ['WARNING', '19.84'])
+        self.assertEqual(rows['broken'], ['UNKNOWN', '-', '-', '-', '-'])
+        self.assertEqual(lines[-2], '# hosts=41 ok=30 warning=10 critical=0 unknown=1')
+        self.assertEqual(lines[-1], '# mem_used_pct p50=7.65 p90=19.84 p99=19.84 max=19.84')
+
+    def test_stream(self):
+        import json
+        stream = [json.dumps({'host': 'db%d' % i, 'data': fixture('meminfo.txt')}) + '\n'
+                  for i in range(5)]
+        code, lines = self.fleet(['--fleet', '-', '--fleet_workers', '1'], stream)
+        self.assertEqual(code, 0)
+        self.assertEqual([line.split('\t')[0] for line in lines[1:6]],
+                         ['db0', 'db1', 'db2', 'db3', 'db4'])
+
+    def test_stream_bad_lines(self):
+        import json
+        good = json.dumps({'host': 'db0', 'data': fixture('meminfo.txt')}) + '\n'
+        stream = ['{"host": "db1", "da\n', json.dumps({'host': 'db2'}) + '\n', '[1]\n', good]
+        code, lines = self.fleet(['--fleet', '-', '--fleet_workers', '1'], stream)
+        self.assertEqual(code, 3)
+        rows = dict((line.split('\t')[0], line.split('\t')[1]) for line in lines[1:-2])
+        self.assertEqual(rows, {'line 1': 'UNKNOWN', 'db2': 'UNKNOWN',
+                                'line 3': 'UNKNOWN', 'db0': 'OK'})
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for i in range(1, 101):
+            histogram.add(i * 0.5)
+        histogram.add(150.0)
+        self.assertEqual(histogram.percentile(50), 25.5)
+        self.assertEqual(histogram.percentile(100), 100.0)
+
+
+class Test_bench(unittest.TestCase):
+
+    def test_compare_results(self):
+        baseline = {'parse_meminfo': 10.0, 'MemoryState': 2.0, 'gone': 1.0}
+        current = {'parse_meminfo': 12.0, 'MemoryState': 3.0, 'new': 100.0}
+        self.assertEqual(compare_results(baseline, current, 0.25),
+                         [('MemoryState', 2.0, 3.0)])
+        self.assertEqual(compare_results(baseline, current, 0.5), [])
+
+
+class Test_startup(unittest.TestCase):
+
+    def run_python(self, *args, **kwargs):
+        p = subprocess.Popen((sys.executable,) + args, cwd=here, env=kwargs.get('env'),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+        out, err = p.communicate()
+        self.assertEqual(p.returncode, 0, err)
+        return out, err
+
+    def test_no_lazy_modules_at_import(self):
+        out, err = self.run_python(
+            '-c', 'import sys, check_mem; print(",".join(sorted('
+            'm for m in %r if m in sys.modules)))' % (LAZY_MODULES,))
+        self.assertEqual(out.strip(), '')
+
+    def test_import_within_budget(self):
+        if sys.version_info < (3, 8):
+            self.skipTest('-X pycache_prefix needs python 3.8')
+        prefix = tempfile.mkdtemp()
+        try:
+            args = ('-X', 'pycache_prefix=' + prefix, '-X', 'importtime',
+                    '-c', 'import check_mem')
+            env = dict(os.environ)
+            env.pop('PYTHONDONTWRITEBYTECODE', None)
+            spent = []
+            # the first run writes the bytecode the others import
+            for i in range(4):
+                out, err = self.run_python(*args, env=env)
+                for line in err.splitlines():
+                    fields = [f.strip() for f in line.split('|')]
+                    if fields[-1] == 'check_mem':
+                        spent.append(int(fields[1]))
+                        break
+                else:
+                    self.fail('check_mem missing from -X importtime output')
+        finally:
+            shutil.rmtree(prefix)
+        spent = min(spent[1:])
+        self.assertTrue(spent < STARTUP_BUDGET_US,
+                        'import check_mem took %dus, budget is %dus' %
+                        (spent, STARTUP_BUDGET_US))
+
+    def test_compile_within_budget(self):
+        with open(os.path.join(here, 'check_mem.py')) as f:
+            source = f.read()
+        timings = []
+        for i in range(5):
+            started = time.time()
+            compile(source, 'check_mem.py', 'exec')
+            timings.append(time.time() - started)
+        spent = min(timings) * 1000000
+        self.assertTrue(spent < COMPILE_BUDGET_US,
+                        'compiling check_mem.py took %dus, budget is %dus' %
+                        (spent, COMPILE_BUDGET_US))
+
+if __name__ == '__main__':
+    unittest.main()